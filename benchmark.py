@@ -0,0 +1,346 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import string
+import sys
+import sysconfig
+import time
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import decomet
+
+def generateWind(rng):
+    unit = rng.choice(['KT', 'KT', 'KT', 'MPS'])
+    speed = rng.randrange(0, 40)
+
+    if rng.random() < 0.1:
+        direction = 'VRB'
+    else:
+        direction = '%03d' % (rng.randrange(0, 36) * 10)
+
+    gust = 'G%02d' % (speed + rng.randrange(5, 25)) if rng.random() < 0.15 else ''
+    groups = ['%s%02d%s%s' % (direction, speed, gust, unit)]
+
+    if direction != 'VRB' and rng.random() < 0.1:
+        start = rng.randrange(0, 36) * 10
+        groups.append('%03dV%03d' % (start, (start + 60) % 360))
+
+    return groups
+
+def generateVisibility(rng):
+    roll = rng.random()
+    if roll < 0.2:
+        return ['CAVOK']
+
+    if roll < 0.5:
+        groups = ['9999']
+    elif roll < 0.6:
+        groups = ['%dKM' % rng.randrange(10, 80)]
+    else:
+        groups = ['%04d' % (rng.randrange(1, 99) * 100)]
+
+    if rng.random() < 0.1:
+        runway = rng.randrange(1, 37)
+        distance = rng.randrange(1, 20) * 50
+        if rng.random() < 0.5:
+            groups.append('R%02d/%04d' % (runway, distance))
+        else:
+            groups.append('R%02d/%04dV%04dN' % (runway, distance, distance + 200))
+
+    return groups
+
+def generateWeather(rng):
+    intensity = rng.choice(['', '', '-', '+'])
+    description = rng.choice(['', '', '', 'SH', 'FZ', 'BL', 'MI', 'BC', 'DR', 'RE'])
+    precipitation = rng.choice(['RA', 'SN', 'DZ', 'BR', 'FG', 'HZ', 'TS', 'GR', 'GS', 'SQ'])
+    return [intensity + description + precipitation]
+
+def generateCloud(rng):
+    cumulonimbus = 'CB' if rng.random() < 0.1 else ''
+    return '%s%03d%s' % (rng.choice(['FEW', 'SCT', 'BKN', 'OVC']), rng.randrange(1, 250), cumulonimbus)
+
+def generateClouds(rng):
+    roll = rng.random()
+    if roll < 0.1:
+        return [rng.choice(['NSC', 'SKC', 'NCD'])]
+
+    groups = [generateCloud(rng) for _ in range(rng.randrange(1, 4))]
+    if roll > 0.95:
+        groups.append('VV%03d' % rng.randrange(0, 10))
+    return groups
+
+def generateTemperature(value):
+    return 'M%02d' % -value if value < 0 else '%02d' % value
+
+def generateRunwayState(rng):
+    runway = rng.randrange(1, 37) + rng.choice([0, 50])
+    depth = rng.choice(['%02d' % rng.randrange(0, 91), str(rng.randrange(92, 100))])
+    friction = rng.choice(['%02d' % rng.randrange(0, 91), rng.choice(['91', '92', '93', '94', '95', '99'])])
+    return '%02d%s%s%s%s' % (runway, rng.choice('0123456789/'), rng.choice('1259'), depth, friction)
+
+def generateTrend(rng):
+    roll = rng.random()
+    if roll < 0.5:
+        return ['NOSIG']
+
+    start = rng.randrange(0, 24)
+    if roll < 0.8:
+        groups = ['TEMPO', '%02d00/%02d00' % (start, (start + 2) % 24)]
+    else:
+        groups = ['FM%02d%02d' % (start, rng.randrange(0, 60))]
+
+    groups += generateWind(rng)[:1]
+    groups += generateVisibility(rng)[:1]
+    if rng.random() < 0.5:
+        groups += generateWeather(rng)
+    groups.append(generateCloud(rng))
+    return groups
+
+def generateMetar(rng):
+    groups = [''.join(rng.choice(string.ascii_uppercase) for _ in range(4)),
+              '%02d%02d%02dZ' % (rng.randrange(1, 29), rng.randrange(0, 24), rng.randrange(0, 60))]
+
+    if rng.random() < 0.2:
+        groups.append('AUTO')
+
+    groups += generateWind(rng)
+
+    visibility = generateVisibility(rng)
+    groups += visibility
+
+    if visibility != ['CAVOK']:
+        if rng.random() < 0.3:
+            groups += generateWeather(rng)
+        groups += generateClouds(rng)
+
+    temperature = rng.randrange(-30, 40)
+    groups.append('%s/%s' % (generateTemperature(temperature), generateTemperature(temperature - rng.randrange(0, 10))))
+
+    groups.append('Q////' if rng.random() < 0.02 else 'Q%04d' % rng.randrange(960, 1050))
+
+    if rng.random() < 0.05:
+        groups.append(generateRunwayState(rng))
+
+    if rng.random() < 0.6:
+        groups += generateTrend(rng)
+        if groups[-1] != 'NOSIG' and rng.random() < 0.3:
+            groups += generateTrend(rng)
+
+    if rng.random() < 0.3:
+        groups += ['RMK', rng.choice(['AO2', 'QFE996', 'SLP132', 'G/O QFE696'])]
+
+    return ' '.join(groups)
+
+def generateCorpus(size, seed=0):
+    rng = random.Random(seed)
+    return [generateMetar(rng) for _ in range(size)]
+
+def measureThroughput(corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for report in corpus:
+            decomet.parseString(report)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(corpus) / best
+
+def measureGroupParsers(corpus):
+    with decomet.profiling() as stats:
+        for report in corpus:
+            decomet.parseString(report)
+
+    return {name: {'calls': group['calls'], 'seconds': group['seconds']}
+            for name, group in stats.snapshot()['groups'].items()}
+
+def buildInfo():
+    #Free-threaded builds set Py_GIL_DISABLED, and the GIL can still be
+    #enabled at run time (PYTHON_GIL=1)
+    freeThreaded = bool(sysconfig.get_config_var('Py_GIL_DISABLED'))
+    gil = sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+    return {'python': platform.python_version(), 'freeThreaded': freeThreaded, 'gil': gil}
+
+def measureBackends(corpus, workers=4, chunkSize=500, repeat=3):
+    #Reports per second of parseMany with each backend, and of a plain loop
+    results = {}
+    for backend in ['serial', 'thread', 'process']:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if backend == 'serial':
+                for report in corpus:
+                    decomet.parseString(report)
+            else:
+                for metar in decomet.parseMany(corpus, workers, chunkSize, backend=backend):
+                    pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[backend] = len(corpus) / best
+    return results
+
+def printBackendResults(size, workers, results):
+    info = buildInfo()
+    print('%s%s, GIL %s, %d workers' % (info['python'], ' free-threaded' if info['freeThreaded'] else '',
+                                        'enabled' if info['gil'] else 'disabled', workers))
+    for backend, reportsPerSecond in results.items():
+        line = '%8s reports %8s: %10.0f reports/s' % (size, backend, reportsPerSecond)
+        if backend != 'serial':
+            line += '  (%.2fx serial)' % (reportsPerSecond / results['serial'])
+        print(line)
+
+def measureService(corpus, clients=8, requestSize=1, workers=None, maxDelay=0.002):
+    #Load test of the decode server on localhost: clients threads, each with
+    #its own keep-alive connection, post requestSize reports per request.
+    requests = [corpus[i:i + requestSize] for i in range(0, len(corpus), requestSize)]
+    local = threading.local()
+
+    with decomet.DecodeService(workers, maxDelay=maxDelay) as service:
+        server = decomet.serveDecoder(service)
+        connections = []
+
+        def post(strings):
+            if not hasattr(local, 'connection'):
+                local.connection = http.client.HTTPConnection(*server.server_address, timeout=30)
+                connections.append(local.connection)
+            local.connection.request('POST', '/decode', json.dumps(strings), {'Content-Type': 'application/json'})
+            response = local.connection.getresponse()
+            response.read()
+            return response.status
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as executor:
+                statuses = list(executor.map(post, requests))
+            elapsed = time.perf_counter() - start
+        finally:
+            for connection in connections:
+                connection.close()
+            server.shutdown()
+            server.server_close()
+
+        stats = service.stats()
+
+    return {'reportsPerSecond': len(corpus) / elapsed,
+            'failedRequests': sum(status != 200 for status in statuses),
+            'reportsPerBatch': stats['reportsPerBatch'],
+            'latency': stats['latency']}
+
+def runBenchmark(sizes, seed=0, repeat=3):
+    results = {'python': platform.python_version(), 'seed': seed, 'sizes': {}}
+
+    for size in sizes:
+        corpus = generateCorpus(size, seed)
+        results['sizes'][str(size)] = {'reportsPerSecond': measureThroughput(corpus, repeat),
+                                       'groups': measureGroupParsers(corpus)}
+
+    return results
+
+def printResults(results, baseline=None):
+    for size, result in results['sizes'].items():
+        line = '%8s reports: %10.0f reports/s' % (size, result['reportsPerSecond'])
+
+        if baseline and size in baseline['sizes']:
+            previous = baseline['sizes'][size]['reportsPerSecond']
+            line += '  (%+.1f%% vs baseline)' % ((result['reportsPerSecond'] / previous - 1) * 100)
+        print(line)
+
+        for name, cost in result['groups'].items():
+            if cost['calls']:
+                line = '    %-18s %8d calls %8.3f us/call' % (name, cost['calls'], cost['seconds'] / cost['calls'] * 1e6)
+
+                if baseline and size in baseline['sizes']:
+                    previous = baseline['sizes'][size]['groups'].get(name)
+                    if previous and previous['calls']:
+                        ratio = (cost['seconds'] / cost['calls']) / (previous['seconds'] / previous['calls'])
+                        line += '  (%+.1f%%)' % ((ratio - 1) * 100)
+                print(line)
+
+def printServiceResults(result):
+    print('service: %10.0f reports/s, %.1f reports/batch, latency p50 %.2f ms p99 %.2f ms, %d failed requests' %
+          (result['reportsPerSecond'], result['reportsPerBatch'], result['latency']['p50'], result['latency']['p99'],
+           result['failedRequests']))
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testCorpusDecodes(self):
+        corpus = generateCorpus(2000, seed=1)
+        self.assertEqual(corpus, generateCorpus(2000, seed=1))
+
+        metars = [decomet.parseString(report) for report in corpus]
+
+        self.assertTrue(any(visibility.get('CAVOK') for metar in metars for visibility in metar.get('visibility', [])))
+        self.assertTrue(any('runways' in visibility for metar in metars for visibility in metar.get('visibility', [])))
+        self.assertTrue(any(' VV' in report for report in corpus))
+        self.assertTrue(any('runway' in metar for metar in metars))
+        self.assertTrue(any('remark' in metar for metar in metars))
+
+        trendTypes = {trend['type'] for metar in metars for trend in metar.get('trends', [])}
+        self.assertEqual(trendTypes, {'No significant change expected', 'temporary', 'change'})
+
+    def testRunBenchmark(self):
+        results = runBenchmark([50], repeat=1)
+        result = results['sizes']['50']
+
+        self.assertGreater(result['reportsPerSecond'], 0)
+        self.assertEqual(result['groups']['parseAirportCode']['calls'], 50)
+        self.assertEqual(decomet.parseWind.__module__, 'decomet')
+
+    def testMeasureBackends(self):
+        results = measureBackends(generateCorpus(300, seed=3), workers=2, chunkSize=50, repeat=1)
+
+        self.assertEqual(sorted(results), ['process', 'serial', 'thread'])
+        self.assertTrue(all(reportsPerSecond > 0 for reportsPerSecond in results.values()))
+        self.assertIn('freeThreaded', buildInfo())
+
+    def testMeasureService(self):
+        result = measureService(generateCorpus(200, seed=2), clients=4, requestSize=5, workers=0)
+
+        self.assertEqual(result['failedRequests'], 0)
+        self.assertGreaterEqual(result['reportsPerBatch'], 5)
+        self.assertGreater(result['reportsPerSecond'], 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure METAR decoding throughput on a synthetic corpus.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--backends', action='store_true',
+                        help='compare the serial, thread and process backends of parseMany instead')
+    parser.add_argument('--service', type=int, metavar='CLIENTS',
+                        help='load test the decode server with this many concurrent clients instead')
+    parser.add_argument('--request-size', type=int, default=1, help='reports per request for --service')
+    parser.add_argument('--workers', type=int, help='worker threads or processes for --backends and --service')
+    args = parser.parse_args()
+
+    if args.backends:
+        workers = args.workers or os.cpu_count() or 1
+        for size in args.sizes:
+            printBackendResults(size, workers, measureBackends(generateCorpus(size, args.seed), workers, repeat=args.repeat))
+        return
+
+    if args.service:
+        for size in args.sizes:
+            printServiceResults(measureService(generateCorpus(size, args.seed), args.service, args.request_size, args.workers))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = runBenchmark(args.sizes, args.seed, args.repeat)
+    printResults(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
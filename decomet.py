@@ -1,7 +1,117 @@
 import urllib.request
+import urllib.parse
+import urllib.error
+import http.client
+import http.server
 import re
+import os
+import sys
+import time
+import threading
+import asyncio
+import queue
+import contextlib
+import functools
+import itertools
+import struct
+import bisect
+import operator
+import datetime
+import json
+import mmap
+import gzip
+import bz2
+import lzma
+import collections.abc
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import Future, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from pprint import pprint
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+windPattern = re.compile('([0-9VRB/]{3})([0-9/]{2})(G([0-9]{2}))?([A-Z]+)')
+visibilityPattern = re.compile("([0-9]{4})(NDV)?|CAVOK|R([0-9]{2})/([0-9]{4})(V([0-9]{4}))?")
+runwayPattern = re.compile("([0-9]{2})(CLRD|([0-9/]{1})([1259]{1})([0-9]{2}))([0-9/]{2})")
+dateLinePattern = re.compile(b"[0-9]{4}/[0-9]{2}/[0-9]{2} [0-9]{2}:[0-9]{2}$")
+
+descMap = {'MI': 'shallow',
+           'PR': 'partial',
+           'BC': 'patches',
+           'DR': 'low drifting',
+           'BL': 'blowing',
+           'SH': 'showers',
+           'FZ': 'freezing',
+           'RE': 'recent',
+           'TS': 'thunderstorm',
+           '': ''}
+
+precipMap = {'DZ': 'drizzle',
+             'RA': 'rain',
+             'SN': 'snow',
+             'GS': 'small of soft hail',
+             'GR': 'hail',
+             'PE': 'ice pellets',
+             'IC': 'ic crystals',
+             'TS': 'thunderstorm',
+             'HZ': 'haze',
+             'BR': 'mist',
+             'FG': 'fog',
+             'FU': 'smoke',
+             'SS': 'sandstorm',
+             'DS': 'duststorm',
+             'PO': 'dust devils',
+             'DU': 'dust',
+             'SQ': 'squall',
+             'FC': 'funnel cloud',
+             'UP': 'unknown precipitation'}
+
+coverageMap = {'FEW': 'few',
+               'SCT': 'scattered',
+               'BKN': 'broken',
+               'OVC': 'overcast'}
+
+typeMap = {'0': 'clear and dry',
+           '1': 'damp',
+           '2': 'wet or puddles',
+           '3': 'frost',
+           '4': 'dry snow',
+           '5': 'wet snow',
+           '6': 'slush',
+           '7': 'ice',
+           '8': 'compacted snow',
+           '9': 'frozen ridges',
+           '/': 'no report'}
+
+extentMap = {'1': '1-10%',
+             '2': '11-25%',
+             '5': '26-50%',
+             '9': '51-100%'}
+
+depthMap = {'00': 'less than 1mm',
+            '92': '10cm',
+            '93': '15cm',
+            '94': '20cm',
+            '95': '25cm',
+            '96': '30cm',
+            '97': '35cm',
+            '98': '40cm',
+            '99': 'rwy not in use'}
+
+frictionMap = {'91': 'poor',
+               '92': 'poor/medium',
+               '93': 'medium',
+               '94': 'medium/good',
+               '95': 'good',
+               '99': 'unreliable measurement'}
+
 def parseAirportCode(tokens, metar):
     #print("Airport ICAO: %s" % tokens[0])
     metar['airport'] = tokens.pop(0)
@@ -33,32 +143,27 @@ def parseTime(tokens, metar):
     
 def parseWind(tokens, wind):
     if not tokens:
-        return
+        return False
     
     token = tokens[0]
     
-    p = re.compile('([0-9VRB/]{3})([0-9/]{2})(G([0-9]{2}))?([A-Z]+)')
-    m = p.match(token)
+    m = windPattern.match(token)
 
     if m:
-        unit = m.group(5)
+        direction, speed, gusts, gustSpeed, unit = m.groups()
         wind['unit'] = unit
 
-        direction = m.group(1)
-
         if direction == "VRB":
             wind['variable'] = True
 
         elif direction != "///":
             wind['direction'] = direction
 
-        speed = m.group(2)
-
         if speed != "//":
             wind['speed'] = speed
 
-        if m.group(3):
-            wind['speed in gusts'] = m.group(3)[-2:]
+        if gusts:
+            wind['speed in gusts'] = gustSpeed
 
         tokens.pop(0)
 
@@ -73,59 +178,64 @@ def parseWind(tokens, wind):
                 varying['to'] = toFrom[1]
 
                 tokens.pop(0)
-        
+
+        return True
+
+    return False
     
 def parseVisibility(tokens, visibility):
 
-    if tokens == []:
+    if not tokens:
         return False
 
-    if len(tokens[0]) == 4 and tokens[0][-2:] == 'KM':
-        visibility['distance'] = tokens[0]
+    token = tokens[0]
+
+    if len(token) == 4 and token[-2:] == 'KM':
+        visibility['distance'] = token
         tokens.pop(0)
 
         return True
 
-    p = re.compile("([0-9]{4})(NDV)?|CAVOK|R([0-9]{2})/([0-9]{4})(V([0-9]{4}))?")
-    
-    m = p.match(tokens[0])
+    m = visibilityPattern.match(token)
     
     if not m:
         return False
 
+    distance, ndv, runway, runwayDistance, varying, varyingTo = m.groups()
+
     if m.group(0) == "CAVOK":
         #print("Ceiling and visibility OK")
         visibility['CAVOK'] = True
     else:
     
-        if m.group(1) == "9999":
+        if distance == "9999":
             visibility['distance'] = "More than 10000"
         else:
-            visibility['distance'] = m.group(1)
+            visibility['distance'] = distance
             
         note = ""
-        if m.group(2) == "NDV":
+        if ndv == "NDV":
             note = " (No directional variation)"
         
-        if m.group(3):
+        if runway:
             runways = {}
             visibility['runways'] = runways
             thisRunway = {}
-            runways[m.group(3)] = thisRunway
+            runways[runway] = thisRunway
 
-            if m.group(5):
-                #print("Runway %s: %s, varying to %s" % (m.group(3), m.group(4), m.group(6)))
-                thisRunway['varying'] = {'from': m.group(4), 'to': m.group(6)}
+            if varying:
+                #print("Runway %s: %s, varying to %s" % (runway, runwayDistance, varyingTo))
+                thisRunway['varying'] = {'from': runwayDistance, 'to': varyingTo}
             else:
-                #print("Runway %s: %s" % (m.group(3), m.group(4)))
-                thisRunway['distance'] = m.group(4)
+                #print("Runway %s: %s" % (runway, runwayDistance))
+                thisRunway['distance'] = runwayDistance
 
     tokens.pop(0)
     
     return True
     
 def parseFog(tokens, precip):
-    if tokens == []:
+    if not tokens:
         return False
     
     token = tokens[0]
@@ -139,36 +249,6 @@ def parseFog(tokens, precip):
         token = token[1:]
         
     
-    descMap = {'MI': 'shallow',
-               'PR': 'partial',
-               'BC': 'patches',
-               'DR': 'low drifting',
-               'BL': 'blowing',
-               'SH': 'showers',
-               'FZ': 'freezing',
-               'RE': 'recent',
-               '': ''}
-    
-    precipMap = {'DZ': 'drizzle',
-                'RA': 'rain',
-                'SN': 'snow',
-                'GS': 'small of soft hail',
-                'GR': 'hail',
-                'PE': 'ice pellets',
-                'IC': 'ic crystals',
-                'TS': 'thunderstorm',
-                'HZ': 'haze',
-                'BR': 'mist',
-                'FG': 'fog',
-                'FU': 'smoke',
-                'SS': 'sandstorm',
-                'DS': 'duststorm',
-                'PO': 'dust devils',
-                'DU': 'dust',
-                'SQ': 'squall',
-                'FC': 'funnel cloud',
-                'UP': 'unknown precipitation'}
-    
     if len(token) == 2:
         desc = ''
         decip = token
@@ -193,83 +273,84 @@ def parseFog(tokens, precip):
     
 def parseClouds(tokens, clouds):
     #TODO: Add octas
-    if tokens == []:
+    if not tokens:
         return False
     
     token = tokens[0]
     coverage = token[0:3] #TODO: Find real METAR with VV
     height = token[3:6]
 
-    if coverage == 'NSC':
+    if coverage in coverageMap:
+        if token[-2:] == "CB": #TODO: Add TCU (Towering Cumulus)
+            #type = " (Cumulonimbus cloud)"
+            clouds['type'] = 'cumulonimbus'
+
+        #print("Clouds: %s at %d feet%s" % (coverageMap[coverage], int(height)*100, type))
+        clouds['coverage'] = coverageMap[coverage]
+        clouds['height'] = str(int(height)*100)
+
+        tokens.pop(0)
+
+        return True
+    elif coverage == 'NSC':
         #print("No significant clouds")
         clouds['status'] = "No significant clouds"
         tokens.pop(0)
+
+        return True
     elif coverage == 'SKC':
         #print("Sky clear")
         clouds['status'] = "Sky clear"
         tokens.pop(0)
+
+        return True
     elif coverage == 'NCD':
         #print("No clouds detected")
         clouds['status'] = "No clouds detected"
         tokens.pop(0)
+
+        return True
     elif coverage[0:2] == 'VV':
         #print("Vertical visibility: %s" % coverage[2:])
         height = token[2:5]
         clouds['vertical visibility'] = str(int(height)*100)
         tokens.pop(0)
-    else:
-        coverageMap = {'FEW': 'few',
-                       'SCT': 'scattered',
-                       'BKN': 'broken',
-                       'OVC': 'overcast'}
-
-        if coverage in coverageMap:
-            
-            type = ""
-            if token[-2:] == "CB": #TODO: Add TCU (Towering Cumulus)
-                #type = " (Cumulonimbus cloud)"
-                clouds['type'] = 'cumulonimbus'
 
-            #print("Clouds: %s at %d feet%s" % (coverageMap[coverage], int(height)*100, type))
-            clouds['coverage'] = coverageMap[coverage]
-            clouds['height'] = str(int(height)*100)
-    
-            tokens.pop(0)
-
-            return True
+        return True
 
     return False
     
 
 def parseTemperatures(tokens, metar):
-    if tokens == []:
+    if not tokens:
         return False
     
-    def parseTemperature(string):
-        if string[0] == 'M':
-            return -int(string[1:])
-        else:
-            return int(string)
-    
     token = tokens[0]
     temps = token.split('/')
     
-    if len(temps) != 2:
+    if len(temps) != 2 or not temps[0] or not temps[1]:
         return False
     
     temperature = temps[0]
     dewpoint = temps[1]
     
-    #print("Temperature %d C, dewpoint %d C" % (parseTemperature(temperature), parseTemperature(dewpoint)))
-    metar['temperature'] = str(parseTemperature(temperature))
-    metar['dew point'] = str(parseTemperature(dewpoint))
+    #print("Temperature %s C, dewpoint %s C" % (temperature, dewpoint))
+    if temperature[0] == 'M':
+        metar['temperature'] = str(-int(temperature[1:]))
+    else:
+        metar['temperature'] = str(int(temperature))
+
+    if dewpoint[0] == 'M':
+        metar['dew point'] = str(-int(dewpoint[1:]))
+    else:
+        metar['dew point'] = str(int(dewpoint))
     
     tokens.pop(0)
 
     return True
     
 def parseQNH(tokens, metar):
-    if tokens == []:
+    if not tokens:
         return False
     
     token = tokens[0]
@@ -283,9 +364,11 @@ def parseQNH(tokens, metar):
     metar['QNH'] = qnh
     
     tokens.pop(0)
+
+    return True
     
 def parseTrend(tokens, trend):
-    if tokens == []:
+    if not tokens:
         return False
 
     def parseSubMetar(tokens, trend):
@@ -353,7 +436,7 @@ def parseRunway(tokens, runway):
     #http://www.flyingineurope.be/MetarRunway.htm
     #http://sto.iki.fi/metar/
     #TODO: Find real data
-    if tokens == []:
+    if not tokens:
         return False
 
     token = tokens[0]
@@ -361,9 +444,7 @@ def parseRunway(tokens, runway):
     if len(token) != 8:
         return False
 
-    p = re.compile("([0-9]{2})(CLRD|([0-9/]{1})([1259]{1})([0-9]{2}))([0-9/]{2})")
-
-    m = p.match(token)
+    m = runwayPattern.match(token)
 
     if int(m.group(1)) < 50:
         runway['runway'] = m.group(1)
@@ -374,35 +455,9 @@ def parseRunway(tokens, runway):
     if m.group(1) == "CLRD":
         status = "Cleared"
 
-    typeMap = {'0': 'clear and dry',
-               '1': 'damp',
-               '2': 'wet or puddles',
-               '3': 'frost',
-               '4': 'dry snow',
-               '5': 'wet snow',
-               '6': 'slush',
-               '7': 'ice',
-               '8': 'compacted snow',
-               '9': 'frozen ridges',
-               '/': 'no report'}
     runway['type'] = typeMap[m.group(3)]
-
-    extentMap = {'1': '1-10%',
-                 '2': '11-25%',
-                 '5': '26-50%',
-                 '9': '51-100%'}
     runway['extent'] = extentMap[m.group(4)]
 
-    depthMap = {'00': 'less than 1mm',
-                '92': '10cm',
-                '93': '15cm',
-                '94': '20cm',
-                '95': '25cm',
-                '96': '30cm',
-                '97': '35cm',
-                '98': '40cm',
-                '99': 'rwy not in use'}
-
     depth = m.group(5)
 
     if int(depth) > 0 and int(depth) <= 90:
@@ -410,13 +465,6 @@ def parseRunway(tokens, runway):
     else:
         runway['depth'] = depthMap[depth]
 
-    frictionMap = {'91': 'poor',
-                   '92': 'poor/medium',
-                   '93': 'medium',
-                   '94': 'medium/good',
-                   '95': 'good',
-                   '99': 'unreliable measurement'}
-
     friction = m.group(6)
 
     if int(friction) <= 90:
@@ -432,7 +480,7 @@ def parseRunway(tokens, runway):
     return True
 
 def parseRemark(tokens, metar):
-    if tokens == []:
+    if not tokens:
         return False
     
     if tokens[0] != "RMK":
@@ -440,109 +488,2973 @@ def parseRemark(tokens, metar):
     
     #print("Remark: %s" % ' '.join(tokens[1:]))
     metar['remark'] = ' '.join(tokens[1:])
+    del tokens[:]
 
-def parseString(string):
+    return True
+
+groupTypes = {}
+groupDispatch = []
+
+def registerGroup(parser, order, firstCharacters, key=None, container=None, accepts=None, repeat=False):
+    #Registers a group parser for the groups starting with one of
+    #firstCharacters. With a container (dict or list) the parser fills a new
+    #dict that is stored, or appended, at metar[key]; otherwise the parser
+    #writes into the metar itself. A parser that does not consume the token
+    #leaves it to the next candidate, and accepts(token) can check the shape
+    #first for parsers that would raise on other tokens. A parser returns
+    #True when it took the group, and removes its tokens from tokens.
+    #Groups must come in increasing order in a report; a repeat group may
+    #follow itself.
+    groupTypes[parser.__name__] = (order, parser, firstCharacters, key, container, accepts, repeat)
+    buildDispatch()
+
+def takeGroup(entry, tokens, metar):
+    #Parses a group with an entry of the dispatch table and returns the
+    #order the next group starts from, or None if the parser did not take it
+    parser, key, container, nextTable, order, nextOrder = entry
+    if container is None:
+        return nextOrder if parser(tokens, metar) else None
+
+    group = {}
+    if not parser(tokens, group):
+        return None
+    if container is dict:
+        metar[key] = group
+    else:
+        metar.setdefault(key, []).append(group)
+    return nextOrder
+
+def acceptingParser(parser, accepts):
+    def accepting(tokens, metar):
+        return accepts(tokens[0]) and parser(tokens, metar)
+    return accepting
+
+def buildDispatch():
+    #groupDispatch[order][character] lists the entries of the group types
+    #that can start with character once the groups before order have been
+    #seen, the last order is past every group. An entry is (parser, key,
+    #container, nextTable, order, nextOrder), nextOrder being the order the
+    #next group starts from (the same order for a repeat group) and
+    #nextTable its table. A profiling wrapper in place of a parser of this
+    #module is used instead of the parser.
+    maxOrder = max(entry[0] for entry in groupTypes.values())
+    dispatch = [{} for order in range(maxOrder + 2)]
+
+    for name, (order, parser, firstCharacters, key, container, accepts, repeat) in sorted(groupTypes.items(), key=lambda item: item[1][0]):
+        wrapper = globals().get(name)
+        if getattr(wrapper, 'parser', None) is parser:
+            parser = wrapper
+
+        if accepts is not None:
+            parser = acceptingParser(parser, accepts)
+        nextOrder = order if repeat and container is list else order + 1
+        entry = (parser, key, container, dispatch[nextOrder], order, nextOrder)
+        for previous in range(order + 1):
+            for character in firstCharacters:
+                dispatch[previous].setdefault(character, []).append(entry)
+
+    #Swapped whole, so a decode running in another thread sees either table
+    global groupDispatch
+    groupDispatch = dispatch
+
+digits = '0123456789'
+weatherCharacters = '-+' + ''.join(sorted(set(code[0] for code in list(descMap) + list(precipMap) if code)))
+
+registerGroup(parseWind, 1, digits + 'V/', 'wind', dict)
+registerGroup(parseVisibility, 2, digits + 'CR', 'visibility', list, repeat=True)
+registerGroup(parseFog, 3, weatherCharacters, 'precipitation', dict)
+registerGroup(parseClouds, 4, 'FSBONV', 'clouds', list, repeat=True)
+registerGroup(parseTemperatures, 5, digits + 'M')
+registerGroup(parseQNH, 6, 'Q')
+registerGroup(parseRunway, 7, digits, 'runway', dict, accepts=runwayPattern.fullmatch)
+registerGroup(parseTrend, 8, 'NTF', 'trends', list, repeat=True)
+registerGroup(parseRemark, 9, 'R')
+
+def parseGroups(tokens, metar):
+    #Routes each token by its first character to the group types that can
+    #start with it at this point of the report, and stops at the first
+    #token none of them takes. The unparsed tokens are left in tokens.
+    #takeGroup written out, this loop is most of the decoding time.
+    table = groupDispatch[0]
+    while tokens:
+        try:
+            entries = table[tokens[0][0]]
+        except (KeyError, IndexError):
+            return
+
+        for parser, key, container, nextTable, order, nextOrder in entries:
+            if container is None:
+                if parser(tokens, metar):
+                    break
+            else:
+                group = {}
+                if parser(tokens, group):
+                    if container is dict:
+                        metar[key] = group
+                    elif key in metar:
+                        metar[key].append(group)
+                    else:
+                        metar[key] = [group]
+                    break
+        else:
+            return
+
+        table = nextTable
+
+def parseString(string, strict=False):
+    #Decoding stops at the first group no group type takes. With strict,
+    #that raises ValueError instead of returning the groups before it.
     #print("-> %s" % metar)
 
     tokens = string.split(' ')
 
+    #Read once, disableProfiling may reset it from another thread
+    stats = profiler
+    if stats is not None:
+        stats.countTokens(len(tokens))
+
     metar = {}
 
     parseAirportCode(tokens, metar)
     parseTime(tokens, metar)
 
-    wind = {}
-    metar['wind'] = wind
-    parseWind(tokens, wind)
+    metar['wind'] = {}
+    parseGroups(tokens, metar)
 
-    visibilityList = []
+    if strict and tokens:
+        raise ValueError('Unparsed group %r' % tokens[0])
 
-    while True:
-        visibility = {}
-        ok = parseVisibility(tokens, visibility)
-        if not ok:
-            break
+    return metar
+
+def parseGroupsLenient(tokens, metar, allTokens, unparsed, errors):
+    #parseGroups that skips tokens it cannot decode instead of stopping.
+    #tokens is the tail of allTokens, so the tokens a failing parser took
+    #can be found again by position.
+    dispatch = groupDispatch
+    total = len(allTokens)
+    order = 0
+    while tokens:
+        position = total - len(tokens)
+        try:
+            for entry in dispatch[order].get(tokens[0][:1], ()):
+                nextOrder = takeGroup(entry, tokens, metar)
+                if nextOrder is not None:
+                    order = nextOrder
+                    break
+            else:
+                errors.append(('unknownGroup', tokens[0]))
+                unparsed.append(tokens.pop(0))
+        except Exception:
+            consumed = total - len(tokens)
+            end = max(consumed, position + 1)
+            del tokens[:end - consumed]
+
+            group = allTokens[position:end]
+            errors.append(('badGroup', ' '.join(group)))
+            unparsed.extend(group)
+
+def parseLenient(string, errorCounts=None):
+    #Decodes as much of a report as possible and never raises. Tokens that
+    #could not be decoded are listed in metar['unparsed'], and the problems
+    #in metar['errors'] as (code, token) pairs with the codes 'empty',
+    #'badTime', 'unknownGroup' and 'badGroup'. errorCounts, a Counter, is
+    #updated with the number of reports, reports with errors and each code.
+    tokens = string.split()
+    allTokens = list(tokens)
 
-        visibilityList.append(visibility)
+    metar = {}
+    unparsed = []
+    errors = []
 
-    if visibilityList:
-        metar['visibility'] = visibilityList
+    if not tokens:
+        errors.append(('empty', string))
+    else:
+        parseAirportCode(tokens, metar)
 
-    precip = {}
-    parseFog(tokens, precip)
-    if precip:
-        metar['precipitation'] = precip
+        if tokens:
+            try:
+                parseTime(tokens, metar)
+            except ValueError:
+                errors.append(('badTime', tokens[0]))
+                unparsed.append(tokens.pop(0))
+
+        metar['wind'] = {}
+        parseGroupsLenient(tokens, metar, allTokens, unparsed, errors)
+
+    if errors:
+        metar['unparsed'] = unparsed
+        metar['errors'] = errors
+
+    if errorCounts is not None:
+        errorCounts['reports'] += 1
+        if errors:
+            errorCounts['reportsWithErrors'] += 1
+        for code, token in errors:
+            errorCounts[code] += 1
 
-    cloudList = []
+    return metar
 
+#Fields that parsers without a container write into the metar, for
+#LazyMetar. Container groups are found from their key in groupTypes.
+fieldParsers = {'temperature': 'parseTemperatures',
+                'dew point': 'parseTemperatures',
+                'QNH': 'parseQNH',
+                'remark': 'parseRemark'}
+
+def parseGroupsUntil(tokens, metar, order, limit):
+    #parseGroups from order that pauses before the first group of a type
+    #ordered above limit. Returns the order to resume from, or None once the
+    #report is done (no tokens left or a token no group type takes).
+    dispatch = groupDispatch
+    while tokens:
+        for entry in dispatch[order].get(tokens[0][:1], ()):
+            if entry[4] > limit:
+                return order
+            nextOrder = takeGroup(entry, tokens, metar)
+            if nextOrder is not None:
+                break
+        else:
+            return None
+
+        order = nextOrder
+
+    return None
+
+class LazyMetar(collections.abc.Mapping):
+    #Read-only view of a report that decodes groups on first access. The
+    #airport and time are decoded up front, the groups only as far as the
+    #field asked for (reading 'wind' decodes the wind group, reading
+    #'trends' everything before it too). Iterating, len() and toDict()
+    #decode the whole report, which gives the same dict as parseString.
+    #Errors parseString would raise are raised by the access that needs
+    #the group.
+    __slots__ = ('metar', 'tokens', 'order')
+
+    def __init__(self, string):
+        self.tokens = string.split(' ')
+        self.metar = {}
+
+        parseAirportCode(self.tokens, self.metar)
+        parseTime(self.tokens, self.metar)
+
+        self.metar['wind'] = {}
+        self.order = 0
+
+    def decode(self, limit):
+        if self.order is not None and self.order <= limit:
+            self.order = parseGroupsUntil(self.tokens, self.metar, self.order, limit)
+
+    def fieldOrder(self, key):
+        #The order of the group type that writes key. Fields of no group
+        #type are decoded up front or unknown (which decodes everything).
+        name = fieldParsers.get(key)
+        if name is None:
+            for name, entry in groupTypes.items():
+                if entry[3] == key:
+                    break
+            else:
+                return -1 if key in self.metar else len(groupDispatch)
+
+        return groupTypes[name][0]
+
+    def __getitem__(self, key):
+        self.decode(self.fieldOrder(key))
+        return self.metar[key]
+
+    def __contains__(self, key):
+        self.decode(self.fieldOrder(key))
+        return key in self.metar
+
+    def __iter__(self):
+        return iter(self.toDict())
+
+    def __len__(self):
+        return len(self.toDict())
+
+    def toDict(self):
+        self.decode(len(groupDispatch))
+        return self.metar
+
+    def __repr__(self):
+        return 'LazyMetar(%r)' % self.metar
+
+def parseLazy(string):
+    return LazyMetar(string)
+
+profiledParsers = ('parseAirportCode', 'parseTime', 'parseWind', 'parseVisibility', 'parseFog',
+                   'parseClouds', 'parseTemperatures', 'parseQNH', 'parseRunway', 'parseTrend',
+                   'parseRemark')
+
+class DecoderStats:
+    #Counters collected while profiling is enabled. A call succeeds when the
+    #parser consumes a token or returns True, fails otherwise and is an error
+    #when it raises. Times include nested parsers (parseTrend calls the
+    #others). tokenCounts is a histogram of the number of groups per report.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.groups = {name: {'calls': 0, 'successes': 0, 'failures': 0, 'errors': 0, 'seconds': 0.0}
+                           for name in profiledParsers}
+            self.tokenCounts = Counter()
+            self.reports = 0
+
+    def countTokens(self, count):
+        with self.lock:
+            self.reports += 1
+            self.tokenCounts[count] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'reports': self.reports,
+                    'tokenCounts': dict(self.tokenCounts),
+                    'groups': {name: dict(group) for name, group in self.groups.items()}}
+
+def profiledParser(stats, name, parser):
+    group = stats.groups[name]
+
+    def wrapper(tokens, result):
+        before = len(tokens)
+        start = time.perf_counter()
+        try:
+            ok = parser(tokens, result)
+        except Exception:
+            elapsed = time.perf_counter() - start
+            with stats.lock:
+                group['calls'] += 1
+                group['errors'] += 1
+                group['seconds'] += elapsed
+            raise
+        elapsed = time.perf_counter() - start
+
+        with stats.lock:
+            group['calls'] += 1
+            if ok is True or len(tokens) < before:
+                group['successes'] += 1
+            else:
+                group['failures'] += 1
+            group['seconds'] += elapsed
+        return ok
+
+    wrapper.parser = parser
+    return wrapper
+
+profiler = None
+profilingLock = threading.Lock()
+
+def enableProfiling():
+    #Replaces the group parsers of this module with timed wrappers. When
+    #disabled the decoder runs unchanged apart from one check per report.
+    #Stats are per process, so a parseMany process pool is not counted.
+    global profiler
+    with profilingLock:
+        if profiler is None:
+            stats = DecoderStats()
+            for name in profiledParsers:
+                globals()[name] = profiledParser(stats, name, globals()[name])
+            buildDispatch()
+            profiler = stats
+        return profiler
+
+def disableProfiling():
+    global profiler
+    with profilingLock:
+        stats = profiler
+        if stats is not None:
+            for name in profiledParsers:
+                globals()[name] = globals()[name].parser
+            buildDispatch()
+            profiler = None
+        return stats
+
+@contextlib.contextmanager
+def profiling():
+    stats = enableProfiling()
+    try:
+        yield stats
+    finally:
+        disableProfiling()
+
+def parseChunk(strings, decoder=parseString):
+    return [decoder(string) for string in strings]
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
     while True:
-        clouds = {}
-        ok = parseClouds(tokens, clouds)
-        if not ok:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+backends = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+def parseMany(strings, workers=None, chunkSize=500, ordered=True, decoder=parseString, backend='process'):
+    #Decodes an iterable of reports on a process pool. Reports are sent to the
+    #workers in chunks, so there is one pickle per chunk and not per report,
+    #and only a few chunks per worker are in flight at a time.
+    #Yields metars in input order, or (index, metar) as chunks complete when
+    #ordered is False. The decoder must be picklable (a module level function).
+    #backend='thread' uses a thread pool instead, which needs no pickling
+    #and takes any decoder, and runs in parallel on free-threaded builds.
+    #Arguments are checked here and not on the first next().
+    if backend not in backends:
+        raise ValueError('Unknown backend %r' % backend)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    return iterateParsed(strings, workers, chunkSize, ordered, decoder, backends[backend])
+
+def iterateParsed(strings, workers, chunkSize, ordered, decoder, executorType):
+    chunks = enumerate(chunked(strings, chunkSize))
+
+    if workers <= 1:
+        for number, chunk in chunks:
+            for i, metar in enumerate(parseChunk(chunk, decoder)):
+                yield metar if ordered else (number * chunkSize + i, metar)
+        return
+
+    executor = executorType(workers)
+    starts = {}
+
+    def submit():
+        for number, chunk in chunks:
+            future = executor.submit(parseChunk, chunk, decoder)
+            starts[future] = number * chunkSize
+            return future
+        return None
+
+    try:
+        inFlight = deque()
+        for _ in range(workers * 2):
+            future = submit()
+            if future is None:
+                break
+            inFlight.append(future)
+
+        if ordered:
+            while inFlight:
+                future = inFlight.popleft()
+                nextFuture = submit()
+                if nextFuture is not None:
+                    inFlight.append(nextFuture)
+
+                del starts[future]
+                yield from future.result()
+        else:
+            pending = set(inFlight)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    nextFuture = submit()
+                    if nextFuture is not None:
+                        pending.add(nextFuture)
+
+                    start = starts.pop(future)
+                    for i, metar in enumerate(future.result()):
+                        yield start + i, metar
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+compressedOpeners = [(b'\x1f\x8b', gzip.open),
+                     (b'BZh', bz2.open),
+                     (b'\xfd7zXZ\x00', lzma.open)]
+
+def readLines(path, start=0, end=None):
+    #Streams the raw lines of a file with bounded memory. Compressed files
+    #are recognised by their magic bytes and decompressed in chunks, plain
+    #files are memory mapped. For plain files start and end select the
+    #lines that start in that byte range.
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+
+        for prefix, opener in compressedOpeners:
+            if magic.startswith(prefix):
+                if start or end is not None:
+                    raise ValueError('Byte ranges of compressed files are not supported')
+                with opener(path, 'rb') as compressed:
+                    yield from compressed
+                return
+
+        if not magic:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if not start and end is None:
+                yield from iter(mapped.readline, b'')
+                return
+
+            if end is None:
+                end = len(mapped)
+            if start:
+                start = mapped.find(b'\n', start - 1) + 1 or len(mapped)
+
+            mapped.seek(start)
+            while mapped.tell() < end:
+                yield mapped.readline()
+
+def readReports(path, start=0, end=None):
+    #Raw reports from an archive with one report per line, optionally in
+    #NOAA's date line + report pairs. Date lines and blank lines are skipped.
+    for line in readLines(path, start, end):
+        line = line.strip()
+        if not line or dateLinePattern.match(line):
+            continue
+
+        yield line.decode('ascii', 'replace')
+
+def readArchive(path, decoder=parseString):
+    for string in readReports(path):
+        yield decoder(string)
+
+class ReportWriter:
+    #Buffers decoded metars and writes them batchSize at a time, each batch
+    #encoded in one call and written with one write. file is a path or a
+    #binary file object, which is left open by close().
+    def __init__(self, file, batchSize=1000):
+        if isinstance(file, (str, os.PathLike)):
+            self.file = open(file, 'wb')
+            self.owned = True
+        else:
+            self.file = file
+            self.owned = False
+
+        self.batchSize = batchSize
+        self.pending = []
+        self.count = 0
+
+    def write(self, metar):
+        self.pending.append(metar)
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def writeMany(self, metars):
+        for metar in metars:
+            self.write(metar)
+
+    def sink(self, filename, metar):
+        #For fetchAll, sweepStations and fetchCycles
+        self.write(metar)
+
+    def flush(self):
+        if self.pending:
+            self.file.write(self.encode(self.pending))
+            self.count += len(self.pending)
+            self.pending = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class JsonLinesWriter(ReportWriter):
+    extension = '.jsonl'
+    encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False).encode
+
+    def encode(self, metars):
+        return ('\n'.join(map(self.encoder, metars)) + '\n').encode('utf-8')
+
+def readJsonLines(path):
+    #Compressed files are read as in readLines
+    for line in readLines(path):
+        if line.strip():
+            yield json.loads(line)
+
+#Binary files start with binaryMagic, followed by frames of a little-endian
+#uint32 length and a batch of metars as one MessagePack array, so any
+#MessagePack library can read a frame. Only the types of decoded metars are
+#written (str, bool, None, int, float, list, tuple and dict); tuples come
+#back as lists, as with JSON. The msgpack package is used when installed,
+#packValue and unpackValue otherwise.
+binaryMagic = b'DCM2'
+frameHeader = struct.Struct('<I')
+
+def packValue(value, out):
+    #Appends the MessagePack encoding of value to the bytearray out
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        length = len(data)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length < 0x100:
+            out += b'\xd9' + length.to_bytes(1, 'big')
+        elif length < 0x10000:
+            out += b'\xda' + length.to_bytes(2, 'big')
+        else:
+            out += b'\xdb' + length.to_bytes(4, 'big')
+        out += data
+    elif isinstance(value, dict):
+        length = len(value)
+        if length < 16:
+            out.append(0x80 | length)
+        elif length < 0x10000:
+            out += b'\xde' + length.to_bytes(2, 'big')
+        else:
+            out += b'\xdf' + length.to_bytes(4, 'big')
+        for key, item in value.items():
+            packValue(key, out)
+            packValue(item, out)
+    elif isinstance(value, (list, tuple)):
+        length = len(value)
+        if length < 16:
+            out.append(0x90 | length)
+        elif length < 0x10000:
+            out += b'\xdc' + length.to_bytes(2, 'big')
+        else:
+            out += b'\xdd' + length.to_bytes(4, 'big')
+        for item in value:
+            packValue(item, out)
+    elif value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if -32 <= value < 128:
+            out.append(value & 0xff)
+        else:
+            out += b'\xd3' + value.to_bytes(8, 'big', signed=True)
+    elif isinstance(value, float):
+        out += struct.pack('>Bd', 0xcb, value)
+    else:
+        raise TypeError('Cannot pack %s' % type(value).__name__)
+
+def unpackValue(data, position=0):
+    #Returns the value at position in data (bytes) and the position after
+    #it. Reads the types packValue writes, in any of their encodings.
+    code = data[position]
+    position += 1
+    #Short strings are most of a metar
+    if 0xa0 <= code < 0xc0:
+        end = position + (code & 0x1f)
+        if end > len(data):
+            raise ValueError('Truncated string')
+        return data[position:end].decode('utf-8'), end
+    if code < 0x80:
+        return code, position
+    if code >= 0xe0:
+        return code - 0x100, position
+
+    if code in (0xd9, 0xda, 0xdb):
+        size = 1 << (code - 0xd9)
+        length = int.from_bytes(data[position:position + size], 'big')
+        position += size
+        end = position + length
+        if end > len(data):
+            raise ValueError('Truncated string')
+        return data[position:end].decode('utf-8'), end
+
+    if code < 0xa0 or code in (0xdc, 0xdd, 0xde, 0xdf):
+        if code < 0xa0:
+            isMap = code < 0x90
+            length = code & 0x0f
+        else:
+            isMap = code >= 0xde
+            size = 2 if code in (0xdc, 0xde) else 4
+            length = int.from_bytes(data[position:position + size], 'big')
+            position += size
+
+        if isMap:
+            value = {}
+            for _ in range(length):
+                key, position = unpackValue(data, position)
+                value[key], position = unpackValue(data, position)
+        else:
+            value = []
+            for _ in range(length):
+                item, position = unpackValue(data, position)
+                value.append(item)
+        return value, position
+
+    if code == 0xc0:
+        return None, position
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, position
+    if 0xcc <= code <= 0xd3:
+        size = 1 << (code - 0xcc) % 4
+        if position + size <= len(data):
+            return int.from_bytes(data[position:position + size], 'big', signed=code >= 0xd0), position + size
+    if code in (0xca, 0xcb):
+        format = '>f' if code == 0xca else '>d'
+        if position + struct.calcsize(format) <= len(data):
+            return struct.unpack_from(format, data, position)[0], position + struct.calcsize(format)
+    raise ValueError('Unsupported or truncated MessagePack value 0x%02x' % code)
+
+class BinaryWriter(ReportWriter):
+    extension = '.bin'
+
+    def __init__(self, file, batchSize=1000):
+        ReportWriter.__init__(self, file, batchSize)
+        self.file.write(binaryMagic)
+
+    def encode(self, metars):
+        if msgpack is not None:
+            frame = msgpack.packb(metars)
+            return frameHeader.pack(len(frame)) + frame
+
+        frame = bytearray(frameHeader.size)
+        packValue(metars, frame)
+        frameHeader.pack_into(frame, 0, len(frame) - frameHeader.size)
+        return frame
+
+def readBinary(path):
+    with open(path, 'rb') as f:
+        if f.read(len(binaryMagic)) != binaryMagic:
+            raise ValueError('%s is not a decomet binary file' % path)
+
+        while True:
+            header = f.read(frameHeader.size)
+            if not header:
+                return
+            length, = frameHeader.unpack(header)
+            frame = f.read(length)
+            if len(frame) != length:
+                raise ValueError('%s ends in a truncated frame' % path)
+            try:
+                if msgpack is not None:
+                    metars, end = msgpack.unpackb(frame), length
+                else:
+                    metars, end = unpackValue(frame)
+            except (IndexError, ValueError):
+                metars, end = None, -1
+            if end != length or not isinstance(metars, list):
+                raise ValueError('%s has a malformed frame' % path)
+            yield from metars
+
+def planShards(paths, shardSize=64 << 20):
+    #Splits plain archives into byte ranges of about shardSize; a range
+    #holds the lines that start in it. Compressed archives can't be split
+    #and are one shard each. The input's size and mtime are kept to notice
+    #when it changes.
+    shards = []
+    for path in paths:
+        status = os.stat(path)
+        with open(path, 'rb') as f:
+            magic = f.read(6)
+        compressed = any(magic.startswith(prefix) for prefix, opener in compressedOpeners)
+
+        step = status.st_size if compressed else shardSize
+        for start in range(0, max(status.st_size, 1), max(step, 1)):
+            shards.append({'path': os.path.abspath(path),
+                           'start': start,
+                           'end': min(start + step, status.st_size),
+                           'compressed': compressed,
+                           'size': status.st_size,
+                           'mtime': status.st_mtime})
+    return shards
+
+def reprocessShard(shard, outputPath, decoder=parseLenient, writer=JsonLinesWriter):
+    #Decodes one shard into outputPath, which only appears once the shard
+    #is complete. Reports the decoder raises on are counted and skipped.
+    start = time.perf_counter()
+    stats = {'reports': 0, 'errors': 0, 'failures': 0, 'bytes': shard['end'] - shard['start']}
+
+    if shard['compressed']:
+        strings = readReports(shard['path'])
+    else:
+        strings = readReports(shard['path'], shard['start'], shard['end'])
+
+    temporaryPath = outputPath + '.tmp'
+    with writer(temporaryPath) as output:
+        for string in strings:
+            try:
+                metar = decoder(string)
+            except Exception:
+                stats['failures'] += 1
+                continue
+
+            stats['reports'] += 1
+            if 'errors' in metar:
+                stats['errors'] += 1
+            output.write(metar)
+    os.replace(temporaryPath, outputPath)
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+def printProgress(progress):
+    print('%d/%d shards, %d reports, %.0f reports/s, %.1f MB/s' %
+          (progress['completed'], progress['shards'], progress['reports'], progress['reportsPerSecond'],
+           progress['bytesPerSecond'] / 1e6))
+
+def reprocessArchives(paths, outputDirectory, workers=None, shardSize=64 << 20, decoder=parseLenient,
+                      writer=JsonLinesWriter, progress=printProgress):
+    #Decodes archives shard by shard on a process pool, into one output file
+    #per shard in outputDirectory. manifest.json there records the shard
+    #plan and the completed shards, and is rewritten as each shard
+    #completes, so running again with the same inputs resumes with the
+    #shards that are not done. Outputs of a previous run that are not kept
+    #as completed shards of this plan are removed. progress(dict) is called after each shard.
+    #The decoder and writer must be picklable. Returns the final progress,
+    #with the shards that raised in 'failed'.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    os.makedirs(outputDirectory, exist_ok=True)
+    manifestPath = os.path.join(outputDirectory, 'manifest.json')
+
+    shards = planShards(paths, shardSize)
+    names = ['shard-%06d%s' % (number, writer.extension) for number in range(len(shards))]
+
+    completed = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as f:
+            manifest = json.load(f)
+        previous = dict(zip(manifest['names'], manifest['shards']))
+        current = dict(zip(names, shards))
+        #Shards planned the same way over unchanged inputs
+        completed = {name: stats for name, stats in manifest['completed'].items()
+                     if name in current and previous.get(name) == current[name]
+                     and os.path.exists(os.path.join(outputDirectory, name))}
+
+        #Removed before the new manifest forgets about them, and so that a
+        #shard that fails this time doesn't leave an old output in its place
+        for name in set(manifest['names']) - set(completed):
+            for path in (os.path.join(outputDirectory, name), os.path.join(outputDirectory, name + '.tmp')):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def saveManifest():
+        temporaryPath = manifestPath + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump({'names': names, 'shards': shards, 'completed': completed}, f)
+        os.replace(temporaryPath, manifestPath)
+
+    saveManifest()
+
+    started = time.perf_counter()
+    state = {'shards': len(shards), 'resumed': len(completed), 'completed': len(completed),
+             'reports': 0, 'errors': 0, 'failures': 0, 'bytes': 0, 'failed': {}}
+
+    def finish(name, stats):
+        completed[name] = stats
+        saveManifest()
+
+        elapsed = time.perf_counter() - started
+        state['completed'] += 1
+        for key in ('reports', 'errors', 'failures', 'bytes'):
+            state[key] += stats[key]
+        state['seconds'] = elapsed
+        state['reportsPerSecond'] = state['reports'] / elapsed if elapsed else 0.0
+        state['bytesPerSecond'] = state['bytes'] / elapsed if elapsed else 0.0
+        if progress is not None:
+            progress(dict(state))
+
+    pending = [(name, shard) for name, shard in zip(names, shards) if name not in completed]
+
+    if workers <= 1:
+        for name, shard in pending:
+            try:
+                stats = reprocessShard(shard, os.path.join(outputDirectory, name), decoder, writer)
+            except Exception as e:
+                state['failed'][name] = e
+                continue
+            finish(name, stats)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(reprocessShard, shard, os.path.join(outputDirectory, name), decoder, writer): name
+                       for name, shard in pending}
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    state['failed'][name] = e
+                    continue
+                finish(name, stats)
+
+    state['seconds'] = time.perf_counter() - started
+    return state
+
+windUnitCodes = ['KT', 'MPS']
+intensityCodes = ['light', 'moderate', 'heavy']
+descriptionCodes = [desc for desc in descMap.values() if desc]
+precipitationCodes = list(precipMap.values())
+coverageCodes = list(coverageMap.values())
+
+def columnDtype(maxClouds=4):
+    #Categorical columns hold an index into the *Codes lists above, -1 when
+    #the group is missing. Numeric columns are NaN when missing.
+    return np.dtype([('airport', 'U4'),
+                     ('day', 'i1'),
+                     ('minutes', 'i2'),
+                     ('automatic', '?'),
+                     ('windDirection', 'f4'),
+                     ('windVariable', '?'),
+                     ('windSpeed', 'f4'),
+                     ('windGust', 'f4'),
+                     ('windUnit', 'i1'),
+                     ('visibility', 'f4'),
+                     ('CAVOK', '?'),
+                     ('precipitationIntensity', 'i1'),
+                     ('precipitationDescription', 'i1'),
+                     ('precipitationType', 'i1'),
+                     ('cloudCoverage', 'i1', (maxClouds,)),
+                     ('cloudHeight', 'f4', (maxClouds,)),
+                     ('cumulonimbus', '?', (maxClouds,)),
+                     ('verticalVisibility', 'f4'),
+                     ('temperature', 'f4'),
+                     ('dewPoint', 'f4'),
+                     ('QNH', 'f4')])
+
+def toNumber(string):
+    try:
+        return float(string)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def visibilityDistance(distance):
+    if distance == "More than 10000":
+        return 10000.0
+    if distance[-2:] == 'KM':
+        return toNumber(distance[:-2]) * 1000
+    return toNumber(distance)
+
+def metarRow(metar, maxClouds=4):
+    #The typed values of a decoded metar, as used for one row of
+    #metarColumns. Categorical values are indexes into the *Codes lists,
+    #day and minutes are -1 if the report has no time (see parseLenient).
+    nan = float('nan')
+    row = {}
+
+    row['airport'] = metar.get('airport', '')
+    row['day'] = int(metar['date']) if 'date' in metar else -1
+    row['minutes'] = packTime(metar['time']) if 'time' in metar else -1
+    row['automatic'] = metar.get('automatic', False)
+
+    wind = metar.get('wind', {})
+    row['windDirection'] = toNumber(wind.get('direction'))
+    row['windVariable'] = wind.get('variable', False)
+    row['windSpeed'] = toNumber(wind.get('speed'))
+    row['windGust'] = toNumber(wind.get('speed in gusts'))
+    unit = wind.get('unit')
+    row['windUnit'] = windUnitCodes.index(unit) if unit in windUnitCodes else -1
+
+    row['visibility'] = nan
+    row['CAVOK'] = False
+    for visibility in metar.get('visibility', []):
+        if visibility.get('CAVOK'):
+            row['CAVOK'] = True
+            row['visibility'] = 10000.0
+            break
+        if visibility.get('distance'):
+            row['visibility'] = visibilityDistance(visibility['distance'])
             break
 
-        cloudList.append(clouds)
+    precip = metar.get('precipitation', {})
+    row['precipitationIntensity'] = intensityCodes.index(precip['intensity']) if precip else -1
+    row['precipitationDescription'] = descriptionCodes.index(precip['description']) if 'description' in precip else -1
+    row['precipitationType'] = precipitationCodes.index(precip['type']) if precip else -1
+
+    coverage = [-1] * maxClouds
+    height = [nan] * maxClouds
+    cumulonimbus = [False] * maxClouds
+    row['verticalVisibility'] = nan
+    layer = 0
+    for clouds in metar.get('clouds', []):
+        if 'vertical visibility' in clouds:
+            row['verticalVisibility'] = toNumber(clouds['vertical visibility'])
+        elif 'coverage' in clouds and layer < maxClouds:
+            coverage[layer] = coverageCodes.index(clouds['coverage'])
+            height[layer] = toNumber(clouds['height'])
+            cumulonimbus[layer] = clouds.get('type') == 'cumulonimbus'
+            layer += 1
+    row['cloudCoverage'] = coverage
+    row['cloudHeight'] = height
+    row['cumulonimbus'] = cumulonimbus
+
+    row['temperature'] = toNumber(metar.get('temperature'))
+    row['dewPoint'] = toNumber(metar.get('dew point'))
+    row['QNH'] = toNumber(metar.get('QNH'))
+
+    return row
+
+def metarColumns(metars, maxClouds=4):
+    #Converts decoded metars into a structured array, one row per report.
+    #Values are collected per column and converted by numpy in one go.
+    if np is None:
+        raise ImportError('Columnar output requires numpy')
+
+    dtype = columnDtype(maxClouds)
+    columns = {name: [] for name in dtype.names}
+
+    for metar in metars:
+        row = metarRow(metar, maxClouds)
+        for name in dtype.names:
+            columns[name].append(row[name])
+
+    array = np.empty(len(columns['airport']), dtype=dtype)
+    for name in dtype.names:
+        array[name] = np.array(columns[name], dtype=dtype[name].base)
+
+    return array
+
+def parseColumns(strings, maxClouds=4, decoder=parseString):
+    return metarColumns((decoder(string) for string in strings), maxClouds)
+
+#Wind speed units to m/s
+windUnitFactors = {'KT': 0.514444, 'MPS': 1.0, 'KMH': 1 / 3.6}
+feet = 0.3048
+statuteMile = 1609.344
+
+def siDtype(maxClouds=4):
+    #Directions in degrees, speeds in m/s, distances and heights in m,
+    #temperatures in K and QNH in Pa. NaN when missing or unknown.
+    #cloudCoverage is an index into coverageCodes as in columnDtype.
+    return np.dtype([('airport', 'U4'),
+                     ('windDirection', 'f4'),
+                     ('windVariable', '?'),
+                     ('windSpeed', 'f4'),
+                     ('windGust', 'f4'),
+                     ('visibility', 'f4'),
+                     ('CAVOK', '?'),
+                     ('cloudCoverage', 'i1', (maxClouds,)),
+                     ('cloudHeight', 'f4', (maxClouds,)),
+                     ('verticalVisibility', 'f4'),
+                     ('temperature', 'f4'),
+                     ('dewPoint', 'f4'),
+                     ('QNH', 'f4')])
+
+def numberArray(strings):
+    #Converts a list of decimal strings to float32, anything else (e.g. '',
+    #'//', '<unknown>') to NaN. Building a numpy string array costs more
+    #than the conversion itself, so the strings are joined into one byte
+    #buffer and the digits of every string are summed with bincount.
+    if not strings:
+        return np.empty(0, dtype=np.float32)
+
+    data = np.frombuffer(('\n'.join(strings) + '\n').encode('ascii', 'replace'), dtype=np.uint8)
+    separators = data == ord('\n')
+    ends = np.flatnonzero(separators)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    string = np.cumsum(separators) - separators
+
+    negative = data[starts] == ord('-')
+    digits = data.astype(np.int16) - ord('0')
+    isDigit = (digits >= 0) & (digits <= 9)
+    other = ~isDigit & ~separators
+    other[starts[negative]] = False
+
+    powers = 10.0 ** np.maximum(ends[string] - np.arange(len(data)) - 1, 0)
+    values = np.bincount(string, weights=np.where(isDigit, digits * powers, 0), minlength=len(strings))
+    invalid = np.bincount(string, weights=other, minlength=len(strings)) > 0
+    invalid |= ends - starts <= negative
+
+    values[negative] *= -1
+    values[invalid] = np.nan
+    return values.astype(np.float32)
+
+def normalizeMetars(metars, maxClouds=4):
+    #Converts decoded metars into an array of siDtype. The strings are
+    #collected in one pass and every column is then converted at once.
+    if np is None:
+        raise ImportError('Normalized output requires numpy')
+
+    metars = list(metars)
+    empty = {}
+
+    airports = [metar.get('airport', '') for metar in metars]
+
+    winds = [metar.get('wind', empty) for metar in metars]
+    directions = [wind.get('direction', '') for wind in winds]
+    variable = [wind.get('variable', False) for wind in winds]
+    speeds = [wind.get('speed', '') for wind in winds]
+    gusts = [wind.get('speed in gusts', '') for wind in winds]
+    nan = float('nan')
+    factors = [windUnitFactors.get(wind.get('unit'), nan) for wind in winds]
+
+    #The first visibility group with a distance, which is nearly always the
+    #first group
+    distances = []
+    scales = []
+    CAVOK = []
+    for groups in (metar.get('visibility', ()) for metar in metars):
+        distance = ''
+        scale = 1
+        for visibility in groups:
+            if 'CAVOK' in visibility:
+                distance = 'CAVOK'
+                break
+            if visibility.get('distance'):
+                distance = visibility['distance']
+                break
+
+        CAVOK.append(distance == 'CAVOK')
+        if distance == 'CAVOK' or distance == 'More than 10000':
+            distance = '10000'
+        elif distance[-2:] == 'KM':
+            distance = distance[:-2]
+            scale = 1000
+        distances.append(distance)
+        scales.append(scale)
+
+    cloudLayers = [metar.get('clouds', ()) for metar in metars]
+    padding = [''] * maxClouds
+    heights = [height for layers in cloudLayers
+               for height in ([clouds['height'] for clouds in layers if 'height' in clouds] + padding)[:maxClouds]]
+    coverageIndex = {coverage: code for code, coverage in enumerate(coverageCodes)}
+    noCoverage = [-1] * maxClouds
+    coverages = [([coverageIndex[clouds['coverage']] for clouds in layers if 'height' in clouds] + noCoverage)[:maxClouds]
+                 for layers in cloudLayers]
+    verticalVisibilities = [next((clouds['vertical visibility'] for clouds in layers if 'vertical visibility' in clouds), '')
+                            if layers else '' for layers in cloudLayers]
+
+    temperatures = [metar.get('temperature', '') for metar in metars]
+    dewPoints = [metar.get('dew point', '') for metar in metars]
+    QNHs = [metar.get('QNH', '') for metar in metars]
+
+    array = np.empty(len(airports), dtype=siDtype(maxClouds))
+    array['airport'] = airports
+    array['windDirection'] = numberArray(directions)
+    array['windVariable'] = variable
+
+    factors = np.array(factors, dtype=np.float32)
+    array['windSpeed'] = numberArray(speeds) * factors
+    array['windGust'] = numberArray(gusts) * factors
+
+    array['visibility'] = numberArray(distances) * np.array(scales, dtype=np.float32)
+    array['CAVOK'] = CAVOK
+
+    array['cloudCoverage'] = np.array(coverages, dtype=np.int8).reshape(len(airports), maxClouds)
+    array['cloudHeight'] = numberArray(heights).reshape(len(airports), maxClouds) * feet
+    array['verticalVisibility'] = numberArray(verticalVisibilities) * feet
+    array['temperature'] = numberArray(temperatures) + 273.15
+    array['dewPoint'] = numberArray(dewPoints) + 273.15
+    array['QNH'] = numberArray(QNHs) * 100
+
+    return array
+
+def parseNormalized(strings, maxClouds=4, decoder=parseString):
+    return normalizeMetars((decoder(string) for string in strings), maxClouds)
+
+flightCategoryCodes = ['VFR', 'MVFR', 'IFR', 'LIFR']
+#Ceiling (ft) and visibility (SM) of each category after VFR, and whether
+#the limits themselves belong to it: MVFR is 1000-3000 ft and/or 3-5 SM
+flightCategoryLimits = [(3000, 5, operator.le),
+                        (1000, 3, operator.lt),
+                        (500, 1, operator.lt)]
+
+def derivedDtype():
+    #flightCategory is an index into flightCategoryCodes, -1 when the
+    #visibility is unknown. ceiling is NaN when there is none,
+    #relativeHumidity is in %, crosswind and headwind are in m/s.
+    return np.dtype([('airport', 'U4'),
+                     ('flightCategory', 'i1'),
+                     ('ceiling', 'f4'),
+                     ('relativeHumidity', 'f4'),
+                     ('crosswind', 'f4'),
+                     ('headwind', 'f4')])
+
+def derivedMetrics(normalized, headings=None):
+    #Derived values of an array from normalizeMetars. headings maps an
+    #airport to the runway heading in degrees used for the wind components,
+    #which are NaN for other airports. Variable wind counts fully as
+    #crosswind. The ceiling is the lowest broken or overcast layer, or the
+    #vertical visibility.
+    result = np.empty(len(normalized), dtype=derivedDtype())
+    result['airport'] = normalized['airport']
+
+    layers = normalized['cloudHeight']
+    covered = normalized['cloudCoverage'] >= coverageCodes.index('broken')
+    ceiling = np.where(covered, layers, np.inf).min(axis=-1, initial=np.inf)
+    ceiling = np.fmin(ceiling, normalized['verticalVisibility'])
+    ceiling[np.isinf(ceiling)] = np.nan
+    result['ceiling'] = ceiling
+
+    #Compared in whole feet and hundredths of a mile, so reported limits
+    #aren't moved across by float32 rounding of the SI columns
+    ceilingFeet = np.round(ceiling / feet)
+    visibility = normalized['visibility']
+    visibilityMiles = np.round(visibility / statuteMile, 2)
+    category = np.zeros(len(normalized), dtype=np.int8)
+    for code, (ceilingLimit, visibilityLimit, within) in enumerate(flightCategoryLimits, 1):
+        #NaN compares False, no ceiling never lowers the category
+        category[within(ceilingFeet, ceilingLimit) | within(visibilityMiles, visibilityLimit)] = code
+    category[np.isnan(visibility)] = -1
+    result['flightCategory'] = category
+
+    #Magnus formula
+    temperature = normalized['temperature'] - 273.15
+    dewPoint = normalized['dewPoint'] - 273.15
+    result['relativeHumidity'] = 100 * np.exp(17.625 * dewPoint / (243.04 + dewPoint) - 17.625 * temperature / (243.04 + temperature))
+
+    heading = np.full(len(normalized), np.nan, dtype=np.float32)
+    if headings:
+        for airport, runwayHeading in headings.items():
+            heading[normalized['airport'] == airport] = runwayHeading
+
+    angle = np.radians(normalized['windDirection'] - heading)
+    speed = normalized['windSpeed']
+    result['crosswind'] = np.where(normalized['windVariable'] & ~np.isnan(heading), speed, np.abs(speed * np.sin(angle)))
+    result['headwind'] = speed * np.cos(angle)
+
+    return result
+
+class DerivedMetrics:
+    #Derived metrics of raw reports with the results of the last maxSize
+    #reports cached, so a report that is unchanged since the last cycle is
+    #not decoded or computed again. Only the misses of a batch are decoded
+    #and go through normalizeMetars and derivedMetrics, together.
+    def __init__(self, headings=None, maxSize=65536, decoder=parseLenient):
+        self.headings = headings
+        self.maxSize = maxSize
+        self.decoder = decoder
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, strings):
+        #rows goes over strings several times
+        strings = list(strings)
+        with self.lock:
+            return np.array(self.rows(strings), dtype=derivedDtype())
+
+    def rows(self, strings):
+        cache = self.cache
+        rows = [cache.get(string) for string in strings]
+
+        missing = {}
+        for string, row in zip(strings, rows):
+            if row is None:
+                missing.setdefault(string, None)
+
+        self.misses += len(missing)
+        self.hits += len(strings) - len(missing)
+
+        if missing:
+            derived = derivedMetrics(normalizeMetars(self.decoder(string) for string in missing), self.headings)
+            for string, row in zip(missing, derived.tolist()):
+                missing[string] = row
+                cache[string] = row
+            rows = [missing[string] if row is None else row for string, row in zip(strings, rows)]
+
+        for string in strings:
+            cache.move_to_end(string)
+        while len(cache) > self.maxSize:
+            cache.popitem(last=False)
+
+        return rows
+
+def packNumber(string, width=0):
+    #Numbers are kept as int when formatting them back gives the same string,
+    #anything else (e.g. '///', '<unknown>') is kept as an interned string.
+    if string is None:
+        return None
+    try:
+        number = int(string)
+    except ValueError:
+        return sys.intern(string)
+    if '%0*d' % (width, number) != string:
+        return sys.intern(string)
+    return number
+
+def unpackNumber(value, width=0):
+    if isinstance(value, int):
+        return '%0*d' % (width, value)
+    return value
+
+def packTime(string):
+    hours, minutes = string.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def unpackTime(minutes):
+    return '%02d:%02d' % divmod(minutes, 60)
+
+class WindRecord:
+    __slots__ = ('unit', 'variable', 'direction', 'speed', 'gust', 'varyingFrom', 'varyingTo')
+
+    def __init__(self, wind):
+        self.unit = wind.get('unit')
+        self.variable = wind.get('variable', False)
+        self.direction = packNumber(wind.get('direction'), 3)
+        self.speed = packNumber(wind.get('speed'), 2)
+        self.gust = packNumber(wind.get('speed in gusts'), 2)
+
+        varying = wind.get('varying')
+        self.varyingFrom = packNumber(varying['from'], 3) if varying else None
+        self.varyingTo = packNumber(varying['to'], 3) if varying else None
+
+    def toDict(self):
+        wind = {}
+        if self.unit is not None:
+            wind['unit'] = self.unit
+        if self.variable:
+            wind['variable'] = True
+        if self.direction is not None:
+            wind['direction'] = unpackNumber(self.direction, 3)
+        if self.speed is not None:
+            wind['speed'] = unpackNumber(self.speed, 2)
+        if self.gust is not None:
+            wind['speed in gusts'] = unpackNumber(self.gust, 2)
+        if self.varyingFrom is not None:
+            wind['varying'] = {'from': unpackNumber(self.varyingFrom, 3),
+                               'to': unpackNumber(self.varyingTo, 3)}
+        return wind
+
+class VisibilityRecord:
+    #distance is in metres. kilometres is the digit count of the 'NNKM' form
+    #(0 for metres), 10000 is the decoded 9999 group.
+    __slots__ = ('CAVOK', 'distance', 'kilometres', 'runway', 'runwayDistance', 'runwayFrom', 'runwayTo')
+
+    def __init__(self, visibility):
+        self.CAVOK = visibility.get('CAVOK', False)
+        self.kilometres = 0
+        self.runway = None
+        self.runwayDistance = None
+        self.runwayFrom = None
+        self.runwayTo = None
+
+        distance = visibility.get('distance')
+        if distance == "More than 10000":
+            self.distance = 10000
+        elif distance is not None and distance[-2:] == 'KM':
+            self.distance = packNumber(distance[:-2], len(distance) - 2)
+            if isinstance(self.distance, int):
+                self.distance *= 1000
+                self.kilometres = len(distance) - 2
+            else:
+                self.distance = sys.intern(distance)
+        else:
+            self.distance = packNumber(distance, 4)
 
-    if cloudList:
-        metar['clouds'] = cloudList
+        for runway, thisRunway in visibility.get('runways', {}).items():
+            self.runway = sys.intern(runway)
+            self.runwayDistance = packNumber(thisRunway.get('distance'), 4)
+            if 'varying' in thisRunway:
+                self.runwayFrom = packNumber(thisRunway['varying']['from'], 4)
+                self.runwayTo = packNumber(thisRunway['varying']['to'], 4)
 
-    parseTemperatures(tokens, metar)
+    def toDict(self):
+        if self.CAVOK:
+            return {'CAVOK': True}
 
-    parseQNH(tokens, metar)
+        visibility = {}
+        if self.kilometres:
+            visibility['distance'] = '%0*dKM' % (self.kilometres, self.distance // 1000)
+        elif self.distance == 10000:
+            visibility['distance'] = "More than 10000"
+        elif self.distance is not None or self.runway is not None:
+            visibility['distance'] = unpackNumber(self.distance, 4)
 
-    runway = {}
-    parseRunway(tokens, runway)
-    if runway:
-        metar['runway'] = runway
+        if self.runway is not None:
+            if self.runwayFrom is not None:
+                thisRunway = {'varying': {'from': unpackNumber(self.runwayFrom, 4),
+                                          'to': unpackNumber(self.runwayTo, 4)}}
+            else:
+                thisRunway = {'distance': unpackNumber(self.runwayDistance, 4)}
+            visibility['runways'] = {self.runway: thisRunway}
+        return visibility
+
+class PrecipitationRecord:
+    __slots__ = ('intensity', 'description', 'type')
+
+    def __init__(self, precip):
+        self.intensity = sys.intern(precip['intensity'])
+        self.description = sys.intern(precip['description']) if 'description' in precip else None
+        self.type = sys.intern(precip['type'])
+
+    def toDict(self):
+        precip = {'intensity': self.intensity}
+        if self.description is not None:
+            precip['description'] = self.description
+        precip['type'] = self.type
+        return precip
+
+class CloudRecord:
+    #height and verticalVisibility are in feet.
+    __slots__ = ('status', 'coverage', 'height', 'cumulonimbus', 'verticalVisibility')
+
+    def __init__(self, clouds):
+        self.status = sys.intern(clouds['status']) if 'status' in clouds else None
+        self.coverage = sys.intern(clouds['coverage']) if 'coverage' in clouds else None
+        self.height = packNumber(clouds.get('height'))
+        self.cumulonimbus = clouds.get('type') == 'cumulonimbus'
+        self.verticalVisibility = packNumber(clouds.get('vertical visibility'))
+
+    def toDict(self):
+        clouds = {}
+        if self.status is not None:
+            clouds['status'] = self.status
+        if self.verticalVisibility is not None:
+            clouds['vertical visibility'] = unpackNumber(self.verticalVisibility)
+        if self.cumulonimbus:
+            clouds['type'] = 'cumulonimbus'
+        if self.coverage is not None:
+            clouds['coverage'] = self.coverage
+            clouds['height'] = unpackNumber(self.height)
+        return clouds
+
+class RunwayRecord:
+    __slots__ = ('runway', 'type', 'extent', 'depth', 'friction')
+
+    def __init__(self, runway):
+        for name in self.__slots__:
+            value = runway.get(name)
+            setattr(self, name, sys.intern(value) if value is not None else None)
+
+    def toDict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+class TrendRecord:
+    #A trend has one visibility and one cloud group, not lists as the metar.
+    __slots__ = ('type', 'start', 'end', 'wind', 'visibility', 'precipitation', 'clouds')
+
+    def __init__(self, trend):
+        self.type = sys.intern(trend['type'])
+        self.start = packTime(trend['from']) if 'from' in trend else None
+        self.end = packTime(trend['to']) if 'to' in trend else None
+
+        self.wind = WindRecord(trend['wind']) if 'wind' in trend else None
+        self.visibility = VisibilityRecord(trend['visibility']) if 'visibility' in trend else None
+        self.precipitation = PrecipitationRecord(trend['precipitation']) if trend.get('precipitation') else None
+        self.clouds = CloudRecord(trend['clouds']) if 'clouds' in trend else None
+
+    def toDict(self):
+        trend = {'type': self.type}
+        if self.start is not None:
+            trend['from'] = unpackTime(self.start)
+        if self.end is not None:
+            trend['to'] = unpackTime(self.end)
+        if self.wind is not None:
+            trend['wind'] = self.wind.toDict()
+            trend['visibility'] = self.visibility.toDict()
+            trend['precipitation'] = self.precipitation.toDict() if self.precipitation else {}
+            trend['clouds'] = self.clouds.toDict()
+        return trend
+
+class MetarRecord:
+    #Compact alternative to the dict from parseString. Numbers are ints,
+    #time and trend times are minutes after midnight, repeated strings are
+    #interned and absent groups are None or empty tuples. toDict() gives
+    #the parseString schema back.
+    __slots__ = ('airport', 'day', 'time', 'automatic', 'wind', 'visibility', 'precipitation',
+                 'clouds', 'temperature', 'dewPoint', 'QNH', 'runway', 'trends', 'remark')
+
+    def __init__(self, metar):
+        self.airport = sys.intern(metar['airport'])
+        self.day = packNumber(metar['date'], 2)
+        self.time = packTime(metar['time'])
+        self.automatic = metar.get('automatic', False)
+
+        self.wind = WindRecord(metar['wind'])
+        self.visibility = tuple(VisibilityRecord(visibility) for visibility in metar.get('visibility', ()))
+        self.precipitation = PrecipitationRecord(metar['precipitation']) if 'precipitation' in metar else None
+        self.clouds = tuple(CloudRecord(clouds) for clouds in metar.get('clouds', ()))
+
+        self.temperature = packNumber(metar.get('temperature'))
+        self.dewPoint = packNumber(metar.get('dew point'))
+        self.QNH = packNumber(metar.get('QNH'), 4)
+
+        self.runway = RunwayRecord(metar['runway']) if 'runway' in metar else None
+        self.trends = tuple(TrendRecord(trend) for trend in metar.get('trends', ()))
+        self.remark = metar.get('remark')
+
+    def toDict(self):
+        metar = {'airport': self.airport,
+                 'date': unpackNumber(self.day, 2),
+                 'time': unpackTime(self.time)}
+        if self.automatic:
+            metar['automatic'] = True
+
+        metar['wind'] = self.wind.toDict()
+        if self.visibility:
+            metar['visibility'] = [visibility.toDict() for visibility in self.visibility]
+        if self.precipitation is not None:
+            metar['precipitation'] = self.precipitation.toDict()
+        if self.clouds:
+            metar['clouds'] = [clouds.toDict() for clouds in self.clouds]
+
+        if self.temperature is not None:
+            metar['temperature'] = unpackNumber(self.temperature)
+            metar['dew point'] = unpackNumber(self.dewPoint)
+        if self.QNH is not None:
+            metar['QNH'] = unpackNumber(self.QNH, 4)
+
+        if self.runway is not None:
+            metar['runway'] = self.runway.toDict()
+        if self.trends:
+            metar['trends'] = [trend.toDict() for trend in self.trends]
+        if self.remark is not None:
+            metar['remark'] = self.remark
+        return metar
+
+def parseRecord(string):
+    return MetarRecord(parseString(string))
+
+def copyMetar(value):
+    #Copies the dicts and lists of a decoded metar, faster than deepcopy
+    #since the leaves are immutable.
+    if isinstance(value, dict):
+        return {key: copyMetar(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copyMetar(item) for item in value]
+    return value
+
+class MetarCache:
+    #LRU cache in front of a decoder, keyed on the raw report. Cached
+    #metars are copied on read so callers can modify what they get back;
+    #pass copy=False if they don't. Decoding errors are not cached.
+    def __init__(self, maxSize=4096, decoder=parseString, copy=True):
+        self.maxSize = maxSize
+        self.decoder = decoder
+        self.copy = copy
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, string):
+        with self.lock:
+            metar = self.entries.get(string)
+            if metar is not None:
+                self.entries.move_to_end(string)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if metar is None:
+            metar = self.decoder(string)
+
+            with self.lock:
+                self.entries[string] = metar
+                if len(self.entries) > self.maxSize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        return copyMetar(metar) if self.copy else metar
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.entries),
+                    'maxSize': self.maxSize}
+
+stationsUrl = 'ftp://tgftp.nws.noaa.gov/data/observations/metar/stations/'
+
+def reportFromStationFile(message):
+    return message.splitlines(True)[1].decode("utf-8").strip() #Remove first line
+
+def stationEntries(listing):
+    #Station files from an FTP listing (file name last on each line) or an
+    #HTML index page from an HTTP mirror, mapped to the size and timestamp
+    #text the listing shows for them ('' if it shows none).
+    if b'<a ' in listing.lower():
+        return {name.decode('ascii'): ' '.join(details.decode('ascii', 'replace').split())
+                for name, details in re.findall(rb'href="([A-Z0-9]+\.TXT)"[^>]*>[^<]*</a>([^<\r\n]*)', listing)}
+
+    entries = {}
+    for line in listing.splitlines():
+        fields = line.decode('ascii', 'replace').split()
+        if fields:
+            entries[fields[-1]] = ' '.join(fields[4:-1])
+    return entries
+
+def stationFilenames(listing):
+    return list(stationEntries(listing))
+
+class StationFetcher:
+    #Fetches urls with a timeout and retries. Each thread keeps its own HTTP
+    #connections and FTP opener, so connections are reused between requests
+    #without being shared across threads.
+    def __init__(self, timeout=30, retries=2, retryDelay=1.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def connection(self, parts):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+
+        key = (parts.scheme, parts.netloc)
+        if key not in self.local.connections:
+            if parts.scheme == 'https':
+                connection = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+            self.local.connections[key] = connection
+            with self.lock:
+                self.opened.append(connection)
+        return self.local.connections[key]
+
+    def close(self):
+        with self.lock:
+            for connection in self.opened:
+                connection.close()
+            self.opened = []
+        self.local = threading.local()
+
+    def fetchOnce(self, url, lastModified=None):
+        #Returns (body, Last-Modified). Over HTTP a lastModified from an
+        #earlier fetch makes the request conditional, and body is None if
+        #the server answers 304 Not Modified.
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme in ('http', 'https'):
+            headers = {'If-Modified-Since': lastModified} if lastModified else {}
+            connection = self.connection(parts)
+            try:
+                connection.request('GET', parts.path or '/', headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+
+            if response.status == 304:
+                return None, lastModified
+            if response.status != 200:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return body, response.getheader('Last-Modified')
+
+        if not hasattr(self.local, 'opener'):
+            self.local.opener = urllib.request.build_opener(urllib.request.CacheFTPHandler)
+            with self.lock:
+                self.opened.append(self.local.opener)
+        with self.local.opener.open(url, timeout=self.timeout) as response:
+            return response.read(), None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch(self, url):
+        return self.fetchIfModified(url)[0]
+
+    def openOnce(self, url):
+        #Returns (response, connection) with the body still unread.
+        #connection is the kept-alive HTTP connection, None for other urls.
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme in ('http', 'https'):
+            connection = self.connection(parts)
+            try:
+                connection.request('GET', parts.path or '/')
+                response = connection.getresponse()
+                if response.status != 200:
+                    response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+
+            if response.status != 200:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return response, connection
+
+        if not hasattr(self.local, 'opener'):
+            self.local.opener = urllib.request.build_opener(urllib.request.CacheFTPHandler)
+            with self.lock:
+                self.opened.append(self.local.opener)
+        return self.local.opener.open(url, timeout=self.timeout), None
+
+    @contextlib.contextmanager
+    def stream(self, url):
+        #Opens url to be read as it downloads, e.g. line by line. Only
+        #opening is retried.
+        response, connection = self.retrying(self.openOnce, url)
+        try:
+            yield response
+        finally:
+            #A partly read response leaves the connection unusable
+            if connection is not None and not response.isclosed():
+                connection.close()
+            response.close()
+
+    def fetchIfModified(self, url, lastModified=None):
+        return self.retrying(self.fetchOnce, url, lastModified)
+
+    def retrying(self, function, *args):
+        attempt = 0
+        while True:
+            try:
+                return function(*args)
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or attempt >= self.retries:
+                    raise
+            except (OSError, http.client.HTTPException):
+                if attempt >= self.retries:
+                    raise
+
+            time.sleep(self.retryDelay * 2 ** attempt)
+            attempt += 1
+
+def fetchAll(sink, url=stationsUrl, filenames=None, workers=16, fetcher=None, decoder=parseString):
+    #Fetches and decodes station files on a thread pool with at most
+    #workers requests in flight. sink(filename, metar) is called from the
+    #calling thread as stations complete. Returns a dict of the stations
+    #that failed to fetch or decode, filename -> exception.
+    if fetcher is None:
+        with StationFetcher() as fetcher:
+            return fetchAll(sink, url, filenames, workers, fetcher, decoder)
+
+    if filenames is None:
+        filenames = stationFilenames(fetcher.fetch(url))
+
+    def fetchStation(filename):
+        return decoder(reportFromStationFile(fetcher.fetch(url + filename)))
+
+    failures = {}
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(fetchStation, filename): filename for filename in filenames}
+
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                metar = future.result()
+            except Exception as e:
+                failures[filename] = e
+                continue
 
-    trendList = []
+            sink(filename, metar)
+
+    return failures
+
+def sweepStations(sink, cacheDirectory, url=stationsUrl, workers=16, fetcher=None, decoder=parseString):
+    #Incremental fetchAll. The raw station files and their listing details
+    #are kept in cacheDirectory, and only stations that changed since the
+    #last sweep are fetched and decoded. A station is skipped when its
+    #listing size/timestamp is unchanged; otherwise it is fetched, with a
+    #conditional request over HTTP, and decoded only if the file differs
+    #from the cached copy. A file that fails to decode is cached and indexed
+    #like the others, with the error under 'failed' in index.json, so it is
+    #not fetched and decoded again until it changes. Returns counts of
+    #fetched, skipped and unchanged stations and the failures dict of
+    #fetchAll.
+    if fetcher is None:
+        with StationFetcher() as fetcher:
+            return sweepStations(sink, cacheDirectory, url, workers, fetcher, decoder)
+
+    os.makedirs(cacheDirectory, exist_ok=True)
+    indexPath = os.path.join(cacheDirectory, 'index.json')
+    index = {}
+    if os.path.exists(indexPath):
+        with open(indexPath) as f:
+            index = json.load(f)
+
+    entries = stationEntries(fetcher.fetch(url))
+
+    def cachedRaw(filename):
+        try:
+            with open(os.path.join(cacheDirectory, filename), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def sweepStation(filename, lastModified):
+        raw = cachedRaw(filename)
+        message, lastModified = fetcher.fetchIfModified(url + filename, lastModified if raw is not None else None)
+        if message is None or message == raw:
+            return None, lastModified, None
+
+        with open(os.path.join(cacheDirectory, filename), 'wb') as f:
+            f.write(message)
+        try:
+            return decoder(reportFromStationFile(message)), lastModified, None
+        except Exception as e:
+            return None, lastModified, e
+
+    stats = {'fetched': 0, 'skipped': 0, 'unchanged': 0, 'failures': {}}
+    futures = {}
+
+    with ThreadPoolExecutor(workers) as executor:
+        for filename, listing in entries.items():
+            entry = index.get(filename)
+            if entry and listing and entry['listing'] == listing:
+                stats['skipped'] += 1
+                continue
 
-    while tokens:
-        trend = {}
-        ok = parseTrend(tokens, trend)
+            lastModified = entry['lastModified'] if entry else None
+            futures[executor.submit(sweepStation, filename, lastModified)] = filename
 
-        if not ok:
-            break
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                metar, lastModified, error = future.result()
+            except Exception as e:
+                stats['failures'][filename] = e
+                continue
+
+            entry = {'listing': entries[filename], 'lastModified': lastModified}
+            if error is not None:
+                entry['failed'] = '%s: %s' % (type(error).__name__, error)
+            elif metar is None and 'failed' in index.get(filename, {}):
+                entry['failed'] = index[filename]['failed']
+            index[filename] = entry
+
+            if error is not None:
+                stats['failures'][filename] = error
+            elif metar is None:
+                stats['unchanged'] += 1
+            else:
+                stats['fetched'] += 1
+                sink(filename, metar)
+
+    temporaryPath = indexPath + '.tmp'
+    with open(temporaryPath, 'w') as f:
+        json.dump(index, f)
+    os.replace(temporaryPath, indexPath)
+
+    return stats
+
+cyclesUrl = 'ftp://tgftp.nws.noaa.gov/data/observations/metar/cycles/'
+
+def cycleFilenames(hours=None):
+    #One cycle file per hour, holding every report received in that hour
+    return ['%02dZ.TXT' % hour for hour in (range(24) if hours is None else hours)]
+
+def cycleReports(lines):
+    #Reports from the lines of a cycle file. Each report follows a date line
+    #and may be continued on more lines, up to a blank line.
+    report = []
+    for line in lines:
+        line = line.strip()
+        if line and not dateLinePattern.match(line):
+            report.append(line)
+        elif report:
+            yield b' '.join(report).decode('ascii', 'replace')
+            report = []
+
+    if report:
+        yield b' '.join(report).decode('ascii', 'replace')
+
+def fetchCycles(sink, url=cyclesUrl, filenames=None, fetcher=None, decoder=parseString):
+    #Bulk alternative to fetchAll: downloads one cycle file per hour and
+    #decodes the reports as the file streams in. sink(filename, metar) is
+    #called for every report, with the cycle filename. Returns a dict of
+    #failures, cycle filename -> exception for files that failed to
+    #download and raw report -> exception for reports that failed to decode.
+    if fetcher is None:
+        with StationFetcher() as fetcher:
+            return fetchCycles(sink, url, filenames, fetcher, decoder)
+
+    if filenames is None:
+        filenames = cycleFilenames()
+
+    failures = {}
+
+    for filename in filenames:
+        try:
+            with fetcher.stream(url + filename) as response:
+                for string in cycleReports(response):
+                    try:
+                        metar = decoder(string)
+                    except Exception as e:
+                        failures[string] = e
+                        continue
+
+                    sink(filename, metar)
+        except (OSError, http.client.HTTPException) as e:
+            failures[filename] = e
+
+    return failures
+
+storeFields = [('windDirection', 'f'),
+               ('windSpeed', 'f'),
+               ('windGust', 'f'),
+               ('windUnit', 'b'),
+               ('visibility', 'f'),
+               ('precipitationIntensity', 'b'),
+               ('precipitationType', 'b'),
+               ('cloudCoverage', '4b'),
+               ('cloudHeight', '4f'),
+               ('verticalVisibility', 'f'),
+               ('temperature', 'f'),
+               ('dewPoint', 'f'),
+               ('QNH', 'f')]
+
+#airport, observation time (epoch seconds), offset and length of the raw
+#report in the .raw file, then storeFields
+storeRecord = struct.Struct('<4sqQI' + ''.join(format for name, format in storeFields))
+
+def storeAirport(airport):
+    #struct pads a short airport with NULs
+    return airport.rstrip(b'\x00').decode('ascii')
+
+def epochSeconds(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp())
+    return int(value)
+
+def observationTime(metar, year, month):
+    #Reports only carry the day and time, the year and month come from the
+    #archive they were read from.
+    hours, minutes = metar['time'].split(':')
+    return datetime.datetime(year, month, int(metar['date']), int(hours), int(minutes), tzinfo=datetime.timezone.utc)
+
+class ObservationStore:
+    #Append-only store of decoded observations. Each observation is a fixed
+    #width storeRecord in a numbered segment file, next to its raw report in
+    #a .raw file, and segments are memory mapped for reading. The index has
+    #a time sorted list of (time, segment, record) per station, rebuilt from
+    #the segments on open, so a station/time range query is a bisect.
+    def __init__(self, directory, segmentSize=1 << 20):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.index = {}
+        self.maps = {}
+        self.count = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        segment = 0
+        while os.path.exists(self.path(segment, '.dat')):
+            self.records = self.load(segment)
+            self.count += self.records
+            segment += 1
+
+        for entries in self.index.values():
+            entries.sort()
+
+        if segment == 0 or self.records >= segmentSize:
+            self.segment = segment
+            self.records = 0
+        else:
+            self.segment = segment - 1
+
+        self.openSegment()
+
+    def path(self, segment, extension):
+        return os.path.join(self.directory, 'segment-%06d%s' % (segment, extension))
+
+    def load(self, segment):
+        #A record cut short by a crash is dropped, and so are the records
+        #from the first one whose raw report didn't make it to the .raw file
+        path = self.path(segment, '.dat')
+        size = os.path.getsize(path)
+        records = size // storeRecord.size
+        rawPath = self.path(segment, '.raw')
+        rawSize = os.path.getsize(rawPath) if os.path.exists(rawPath) else 0
+
+        loaded = []
+        if records:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for number in range(records):
+                    airport, observed, rawOffset, rawLength = struct.unpack_from('<4sqQI', mapped, number * storeRecord.size)
+                    if rawOffset + rawLength > rawSize:
+                        records = number
+                        break
+                    loaded.append((storeAirport(airport), observed, number))
+
+        if records * storeRecord.size != size:
+            os.truncate(path, records * storeRecord.size)
+
+        #Sorted once all segments are loaded, in __init__
+        for airport, observed, number in loaded:
+            self.index.setdefault(airport, []).append((observed, segment, number))
+        return records
+
+    def openSegment(self):
+        self.data = open(self.path(self.segment, '.dat'), 'ab')
+        self.raw = open(self.path(self.segment, '.raw'), 'ab')
+
+    def append(self, string, observed, metar=None):
+        #Stores a report observed at observed (a datetime or epoch seconds).
+        #It is decoded with parseLenient unless the metar is given.
+        if metar is None:
+            metar = parseLenient(string)
+
+        if self.records >= self.segmentSize:
+            self.data.close()
+            self.raw.close()
+            self.segment += 1
+            self.records = 0
+            self.openSegment()
+
+        observed = epochSeconds(observed)
+        airport = metar.get('airport', '')[:4].encode('ascii', 'replace')
+        row = metarRow(metar)
+
+        values = []
+        for name, format in storeFields:
+            if format[0].isdigit():
+                values.extend(row[name])
+            else:
+                values.append(row[name])
+
+        #The raw report goes first, so a record never points past it
+        raw = string.encode('utf-8')
+        rawOffset = self.raw.tell()
+        self.raw.write(raw)
+        self.data.write(storeRecord.pack(airport, observed, rawOffset, len(raw), *values))
+
+        entries = self.index.setdefault(storeAirport(airport), [])
+        entry = (observed, self.segment, self.records)
+        if entries and entries[-1] > entry:
+            bisect.insort(entries, entry)
+        else:
+            entries.append(entry)
+
+        self.records += 1
+        self.count += 1
+
+    def flush(self):
+        self.raw.flush()
+        self.data.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.raw.close()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def stations(self):
+        return sorted(self.index)
+
+    def mapped(self, segment, extension, end):
+        #Maps are reused until a read goes past their end
+        key = (segment, extension)
+        mapped = self.maps.get(key)
+        if mapped is None or len(mapped) < end:
+            if segment == self.segment:
+                self.flush()
+            if mapped is not None:
+                mapped.close()
+            with open(self.path(segment, extension), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[key] = mapped
+        return mapped
+
+    def read(self, segment, number, raw=False):
+        offset = number * storeRecord.size
+        values = storeRecord.unpack_from(self.mapped(segment, '.dat', offset + storeRecord.size), offset)
+
+        observation = {'airport': storeAirport(values[0]), 'observed': values[1]}
+        position = 4
+        for name, format in storeFields:
+            if format[0].isdigit():
+                width = int(format[:-1])
+                observation[name] = list(values[position:position + width])
+                position += width
+            else:
+                observation[name] = values[position]
+                position += 1
+
+        if raw:
+            rawOffset, rawLength = values[2], values[3]
+            observation['raw'] = self.mapped(segment, '.raw', rawOffset + rawLength)[rawOffset:rawOffset + rawLength].decode('utf-8')
+        return observation
+
+    def query(self, airport, start=None, end=None, raw=False):
+        #Observations of a station with start <= time < end, in time order
+        entries = self.index.get(airport, [])
+        first = bisect.bisect_left(entries, (epochSeconds(start),)) if start is not None else 0
+        last = bisect.bisect_left(entries, (epochSeconds(end),)) if end is not None else len(entries)
+
+        return [self.read(segment, number, raw) for observed, segment, number in entries[first:last]]
+
+    def reports(self, airport, start=None, end=None):
+        #The raw reports, for decoding again
+        return [observation['raw'] for observation in self.query(airport, start, end, raw=True)]
+
+def recentObservationTime(metar, now=None):
+    #The latest time with the day and time of the report that is not more
+    #than an hour after now (default the current time), for live reports
+    #that carry no month.
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    elif not isinstance(now, datetime.datetime):
+        now = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    if 'date' not in metar or 'time' not in metar:
+        raise ValueError('No day and time in report')
+
+    year, month = now.year, now.month
+    for _ in range(3):
+        try:
+            observed = observationTime(metar, year, month)
+        except ValueError:
+            observed = None
+        if observed is not None and observed <= now + datetime.timedelta(hours=1):
+            return observed
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    raise ValueError('No recent day %s' % metar['date'])
+
+class RollingWindow:
+    #Minimum, maximum and sum of the values of the last length seconds. The
+    #minimum and maximum come from monotonic deques, so adding and expiring
+    #are O(1) amortized, and only the samples inside the window are kept.
+    __slots__ = ('length', 'samples', 'total', 'minimums', 'maximums')
+
+    def __init__(self, length):
+        self.length = length
+        self.samples = deque()
+        self.total = 0.0
+        self.minimums = deque()
+        self.maximums = deque()
+
+    def add(self, time, value):
+        sample = (time, value)
+        self.samples.append(sample)
+        self.total += value
+
+        minimums = self.minimums
+        while minimums and minimums[-1][1] >= value:
+            minimums.pop()
+        minimums.append(sample)
+
+        maximums = self.maximums
+        while maximums and maximums[-1][1] <= value:
+            maximums.pop()
+        maximums.append(sample)
+
+        self.expire(time)
+
+    def expire(self, now):
+        samples = self.samples
+        start = now - self.length
+        while samples and samples[0][0] <= start:
+            sample = samples.popleft()
+            self.total -= sample[1]
+            if self.minimums[0] is sample:
+                self.minimums.popleft()
+            if self.maximums[0] is sample:
+                self.maximums.popleft()
+
+    def snapshot(self):
+        #change is the last value minus the first, e.g. the pressure tendency
+        if not self.samples:
+            return None
+        return {'count': len(self.samples),
+                'min': self.minimums[0][1],
+                'max': self.maximums[0][1],
+                'mean': self.total / len(self.samples),
+                'change': self.samples[-1][1] - self.samples[0][1]}
+
+#Rolled metrics: temperature in C, gust in m/s, visibility in m, QNH in hPa
+rollingMetrics = ('temperature', 'gust', 'visibility', 'QNH')
+
+class RollingStatistics:
+    #Windowed statistics of each station over a stream of decoded reports.
+    #Reports of a station must arrive in time order, older or repeated
+    #reports are counted in late and ignored. Missing values are skipped.
+    #Reports without a usable day and time (e.g. a bad time group decoded by
+    #parseLenient) are counted in undated and ignored.
+    def __init__(self, windows=None):
+        if windows is None:
+            windows = {'1h': 3600, '6h': 6 * 3600, '24h': 24 * 3600}
+        self.windows = dict(windows)
+        self.stations = {}
+        self.latest = {}
+        self.late = 0
+        self.undated = 0
+        self.lock = threading.Lock()
+
+    def add(self, metar, observed=None):
+        #observed is a datetime or epoch seconds, by default the most recent
+        #time matching the report (see recentObservationTime)
+        if observed is None:
+            try:
+                observed = recentObservationTime(metar)
+            except ValueError:
+                with self.lock:
+                    self.undated += 1
+                return
+        observed = epochSeconds(observed)
+
+        row = metarRow(metar)
+        unit = row['windUnit']
+        values = {'temperature': row['temperature'],
+                  'gust': row['windGust'] * windUnitFactors[windUnitCodes[unit]] if unit >= 0 else float('nan'),
+                  'visibility': row['visibility'],
+                  'QNH': row['QNH']}
+
+        airport = metar['airport']
+        with self.lock:
+            if observed <= self.latest.get(airport, observed - 1):
+                self.late += 1
+                return
+            self.latest[airport] = observed
+
+            station = self.stations.get(airport)
+            if station is None:
+                station = {metric: {name: RollingWindow(length) for name, length in self.windows.items()}
+                           for metric in rollingMetrics}
+                self.stations[airport] = station
+
+            for metric, value in values.items():
+                if value == value:
+                    for window in station[metric].values():
+                        window.add(observed, value)
+
+    def sink(self, filename, metar):
+        #For fetchAll and the other fetchers
+        self.add(metar)
+
+    def snapshot(self, now=None):
+        #station -> metric -> window name -> statistics (None if the window
+        #is empty), as of now (default the newest report of the station)
+        now = epochSeconds(now) if now is not None else None
+        with self.lock:
+            snapshot = {}
+            for airport, station in self.stations.items():
+                stationNow = self.latest[airport] if now is None else now
+                snapshot[airport] = {}
+                for metric, windows in station.items():
+                    snapshot[airport][metric] = {}
+                    for name, window in windows.items():
+                        window.expire(stationNow)
+                        snapshot[airport][metric][name] = window.snapshot()
+            return snapshot
+
+#Bucket upper bounds of the numeric indexes, at the usual operational minima
+heightBuckets = [100, 200, 300, 500, 700, 1000, 1500, 2000, 3000, 5000, 10000]
+distanceBuckets = [50, 100, 150, 200, 300, 400, 550, 800, 1500, 3000, 5000, 8000, 10000]
+
+class BucketIndex:
+    #Stations by a numeric value. Queries take whole buckets and only
+    #compare values in the bucket the limit falls in.
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [set() for _ in range(len(bounds) + 1)]
+        self.values = {}
+
+    def add(self, station, value):
+        self.values[station] = value
+        self.buckets[bisect.bisect_right(self.bounds, value)].add(station)
+
+    def remove(self, station):
+        value = self.values.pop(station, None)
+        if value is not None:
+            self.buckets[bisect.bisect_right(self.bounds, value)].discard(station)
+
+    def below(self, limit):
+        edge = bisect.bisect_right(self.bounds, limit)
+        stations = set().union(*self.buckets[:edge])
+        values = self.values
+        stations.update(station for station in self.buckets[edge] if values[station] < limit)
+        return stations
+
+    def atLeast(self, limit):
+        edge = bisect.bisect_right(self.bounds, limit)
+        stations = set().union(*self.buckets[edge + 1:])
+        values = self.values
+        stations.update(station for station in self.buckets[edge] if values[station] >= limit)
+        return stations
+
+class WeatherIndex:
+    #Inverted index of the latest report of each station. Adding a report
+    #replaces the previous one of the same station. Queries return sets of
+    #stations, so they can be combined with | and &.
+    #Numeric indexes: visibility and runwayVisibility (lowest runway visual
+    #range) in meters, verticalVisibility and ceiling (lowest broken or
+    #overcast layer) in feet, and the lowest layer of each cloud coverage.
+    numericBounds = {'visibility': distanceBuckets,
+                     'runwayVisibility': distanceBuckets,
+                     'verticalVisibility': heightBuckets,
+                     'ceiling': heightBuckets}
+    numericBounds.update((coverage, heightBuckets) for coverage in coverageCodes)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.numeric = {name: BucketIndex(bounds) for name, bounds in self.numericBounds.items()}
+        self.keys = {}
+        self.metars = {}
+
+    def terms(self, metar):
+        keys = []
+        values = {}
+
+        precip = metar.get('precipitation')
+        if precip:
+            keys.append(('type', precip['type']))
+            keys.append(('intensity', precip['intensity']))
+            keys.append(('description', precip.get('description')))
+
+        for visibility in metar.get('visibility', []):
+            if visibility.get('CAVOK'):
+                keys.append(('CAVOK',))
+                values.setdefault('visibility', 10000.0)
+            elif visibility.get('distance'):
+                values.setdefault('visibility', visibilityDistance(visibility['distance']))
+
+            for runway in visibility.get('runways', {}).values():
+                distance = toNumber(runway['varying']['from'] if 'varying' in runway else runway.get('distance'))
+                if distance == distance:
+                    values['runwayVisibility'] = min(distance, values.get('runwayVisibility', distance))
+
+        for clouds in metar.get('clouds', []):
+            if 'vertical visibility' in clouds:
+                values['verticalVisibility'] = toNumber(clouds['vertical visibility'])
+            elif 'coverage' in clouds:
+                coverage = clouds['coverage']
+                height = toNumber(clouds['height'])
+                keys.append(('coverage', coverage))
+                if clouds.get('type') == 'cumulonimbus':
+                    keys.append(('cumulonimbus',))
+                values[coverage] = min(height, values.get(coverage, height))
+                if coverage in ('broken', 'overcast'):
+                    values['ceiling'] = min(height, values.get('ceiling', height))
+
+        runway = metar.get('runway')
+        if runway:
+            keys.append(('runwayType', runway['type']))
+            keys.append(('runwayExtent', runway['extent']))
+
+        #nan never matches a query
+        values = {name: value for name, value in values.items() if value == value}
+        return keys, values
+
+    def add(self, metar):
+        station = metar['airport']
+        keys, values = self.terms(metar)
+
+        with self.lock:
+            self.discard(station)
+
+            for key in keys:
+                self.postings.setdefault(key, set()).add(station)
+            for name, value in values.items():
+                self.numeric[name].add(station, value)
+
+            self.keys[station] = (keys, values)
+            self.metars[station] = metar
+
+    def sink(self, filename, metar):
+        #For fetchAll and sweepStations
+        self.add(metar)
+
+    def discard(self, station):
+        keys, values = self.keys.pop(station, ((), ()))
+        for key in keys:
+            stations = self.postings[key]
+            stations.discard(station)
+            if not stations:
+                del self.postings[key]
+        for name in values:
+            self.numeric[name].remove(station)
+        self.metars.pop(station, None)
+
+    def remove(self, station):
+        with self.lock:
+            self.discard(station)
+
+    def __len__(self):
+        return len(self.metars)
+
+    def __getitem__(self, station):
+        return self.metars[station]
+
+    def lookup(self, key):
+        return set(self.postings.get(key, ()))
+
+    def weather(self, type=None, intensity=None, description=None):
+        #Stations reporting weather matching all the given arguments, e.g.
+        #weather('rain', 'heavy', 'thunderstorm') for +TSRA
+        with self.lock:
+            sets = [self.postings.get(key, set()) for key in
+                    (('type', type), ('intensity', intensity), ('description', description)) if key[1] is not None]
+            if not sets:
+                return set().union(*(stations for key, stations in self.postings.items() if key[0] == 'type'))
+            sets.sort(key=len)
+            return sets[0].intersection(*sets[1:])
+
+    def clouds(self, coverage, below=None):
+        #Stations with a layer of the given coverage, optionally based below
+        #a height in feet
+        with self.lock:
+            if below is None:
+                return self.lookup(('coverage', coverage))
+            return self.numeric[coverage].below(below)
+
+    def cumulonimbus(self):
+        with self.lock:
+            return self.lookup(('cumulonimbus',))
+
+    def CAVOK(self):
+        with self.lock:
+            return self.lookup(('CAVOK',))
+
+    def runwayState(self, type=None, extent=None):
+        with self.lock:
+            sets = [self.postings.get(key, set()) for key in
+                    (('runwayType', type), ('runwayExtent', extent)) if key[1] is not None]
+            if not sets:
+                return set().union(*(stations for key, stations in self.postings.items() if key[0] == 'runwayType'))
+            return sets[0].intersection(*sets[1:])
+
+    def below(self, name, limit):
+        #Stations where a numeric index is below limit, e.g.
+        #below('runwayVisibility', 550)
+        with self.lock:
+            return self.numeric[name].below(limit)
+
+    def atLeast(self, name, limit):
+        with self.lock:
+            return self.numeric[name].atLeast(limit)
+
+missing = object()
+
+def diffFields(old, new, prefix, changed, removed):
+    #Fills changed (path -> new value) and removed (paths) with the
+    #differences between two decoded dicts. Nested dicts are compared field
+    #by field, anything else (lists of groups included) is replaced whole.
+    for key, value in new.items():
+        previous = old.get(key, missing)
+        if previous is value or previous == value:
+            continue
+        if type(value) is dict and type(previous) is dict:
+            diffFields(previous, value, prefix + key + '.', changed, removed)
+        else:
+            changed[prefix + key] = value
+
+    for key in old:
+        if key not in new:
+            removed.append(prefix + key)
+
+class DeltaEncoder:
+    #Keeps the last decoded report of each airport and encodes the next one
+    #as the fields that changed. Paths join nested keys with '.', e.g.
+    #'wind.speed'. The first report of an airport is sent whole:
+    #  {'airport': 'ESSL', 'sequence': 0, 'metar': {...}}
+    #  {'airport': 'ESSL', 'sequence': 1, 'set': {'time': '05:50', 'wind.speed': '04'}, 'unset': ['trends']}
+    #encode() returns None for a report identical to the previous one.
+    #Metars must not be changed after they are encoded.
+    def __init__(self, output=None):
+        self.output = output
+        self.previous = {}
+        self.sequences = {}
+
+    def encode(self, metar):
+        airport = metar['airport']
+        previous = self.previous.get(airport)
+        self.previous[airport] = metar
+
+        if previous is None:
+            self.sequences[airport] = 0
+            return {'airport': airport, 'sequence': 0, 'metar': metar}
+
+        changed = {}
+        removed = []
+        diffFields(previous, metar, '', changed, removed)
+        if not changed and not removed:
+            return None
+
+        sequence = self.sequences[airport] + 1
+        self.sequences[airport] = sequence
+        delta = {'airport': airport, 'sequence': sequence}
+        if changed:
+            delta['set'] = changed
+        if removed:
+            delta['unset'] = removed
+        return delta
+
+    def sink(self, filename, metar):
+        #For fetchAll and the other fetchers, passes the deltas on to output
+        delta = self.encode(metar)
+        if delta is not None and self.output is not None:
+            self.output(delta)
+
+    def full(self, airport):
+        #Restarts an airport with its whole report, e.g. for a new consumer
+        self.sequences[airport] = 0
+        return {'airport': airport, 'sequence': 0, 'metar': self.previous[airport]}
+
+class DeltaApplier:
+    #Rebuilds the reports from DeltaEncoder output. apply() returns the new
+    #report of the airport, a new dict that shares the unchanged groups with
+    #the previous one. A missed delta raises ValueError, the airport has to
+    #be restarted with a full report.
+    def __init__(self):
+        self.state = {}
+        self.sequences = {}
+
+    def apply(self, delta):
+        airport = delta['airport']
+        sequence = delta['sequence']
+
+        if 'metar' in delta:
+            metar = delta['metar']
+        else:
+            if self.sequences.get(airport, -2) + 1 != sequence:
+                raise ValueError('Delta %d of %s does not follow %s' % (sequence, airport, self.sequences.get(airport)))
+
+            metar = dict(self.state[airport])
+            copied = set()
+
+            for path, value in delta.get('set', {}).items():
+                target, key = self.parent(metar, path, copied)
+                target[key] = value
+            for path in delta.get('unset', ()):
+                target, key = self.parent(metar, path, copied)
+                del target[key]
+
+        self.state[airport] = metar
+        self.sequences[airport] = sequence
+        return metar
+
+    def parent(self, metar, path, copied):
+        #The dict holding the last key of path, copied before it is changed
+        keys = path.split('.')
+        target = metar
+        for depth in range(len(keys) - 1):
+            prefix = '.'.join(keys[:depth + 1])
+            if prefix not in copied:
+                target[keys[depth]] = dict(target.get(keys[depth], {}))
+                copied.add(prefix)
+            target = target[keys[depth]]
+        return target, keys[-1]
+
+class Subscription:
+    #A bounded queue of (filename, metar) for the reports of airports
+    #starting with one of prefixes (all airports if there are none). When
+    #the queue is full, policy 'block' makes the publisher wait (and so
+    #slows the sweep), 'dropOldest' and 'dropNewest' drop a report and
+    #count it in dropped. Iterate with async for, or await get().
+    policies = ('block', 'dropOldest', 'dropNewest')
+
+    def __init__(self, hub, prefixes=(), maxSize=100, policy='block'):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy %r' % policy)
+
+        self.hub = hub
+        self.prefixes = tuple(prefixes)
+        self.policy = policy
+        self.queue = asyncio.Queue(maxSize)
+        self.dropped = 0
+
+    def matches(self, airport):
+        return not self.prefixes or airport.startswith(self.prefixes)
+
+    async def put(self, item):
+        if self.policy == 'block':
+            await self.queue.put(item)
+            return
+
+        if self.queue.full():
+            self.dropped += 1
+            if self.policy == 'dropNewest':
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+class ObservationHub:
+    #Fans decoded reports out to subscriptions. Use from one event loop.
+    def __init__(self):
+        self.subscriptions = []
+        self.published = 0
+
+    def subscribe(self, prefixes=(), maxSize=100, policy='block'):
+        subscription = Subscription(self, prefixes, maxSize, policy)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    async def publish(self, filename, metar):
+        self.published += 1
+        airport = metar.get('airport', '')
+        for subscription in list(self.subscriptions):
+            if subscription.matches(airport):
+                await subscription.put((filename, metar))
+
+async def watchStations(hub, cacheDirectory, interval=300, url=stationsUrl, workers=16, fetcher=None,
+                        decoder=parseString, rounds=None):
+    #Runs sweepStations every interval seconds (from the start of one sweep
+    #to the start of the next) and publishes the new reports to hub as they
+    #are decoded, so a report is out as soon as its station is fetched and
+    #not at the end of the sweep. Runs until cancelled, or for rounds sweeps
+    #and returns the stats of the last one. A sweep that fails, e.g. on the
+    #station listing, is reported in its stats as 'error' and retried on
+    #the next round.
+    if fetcher is None:
+        with StationFetcher() as fetcher:
+            return await watchStations(hub, cacheDirectory, interval, url, workers, fetcher, decoder, rounds)
+
+    loop = asyncio.get_running_loop()
+
+    def sink(filename, metar):
+        asyncio.run_coroutine_threadsafe(hub.publish(filename, metar), loop).result()
+
+    count = 0
+    while True:
+        start = loop.time()
+        try:
+            stats = await asyncio.to_thread(sweepStations, sink, cacheDirectory, url, workers, fetcher, decoder)
+        except (OSError, http.client.HTTPException) as e:
+            stats = {'error': e}
+
+        count += 1
+        if rounds is not None and count >= rounds:
+            return stats
+
+        await asyncio.sleep(max(0, start + interval - loop.time()))
+
+class DecodeService:
+    #Decodes reports for concurrent callers. Requests are queued, and a
+    #dispatcher thread coalesces whatever arrives within maxDelay seconds
+    #(up to maxBatch reports) into one batch for the process pool, so the
+    #workers see a few large chunks instead of many single reports.
+    #workers=0 decodes on the dispatcher thread. The decoder must be
+    #picklable, parseLenient by default so one bad report can't fail a batch.
+    #If a worker process dies, the batches it takes down fail with
+    #BrokenProcessPool and the pool is replaced before the next batch.
+    def __init__(self, workers=None, maxBatch=256, maxDelay=0.002, decoder=parseLenient, latencyWindow=10000):
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.decoder = decoder
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.executor = None
+        self.broken = False
+
+        if workers > 0:
+            self.executor = self.startPool()
+
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.reports = 0
+        self.batches = 0
+        self.errors = 0
+        self.restarts = 0
+        self.latencies = deque(maxlen=latencyWindow)
+
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def startPool(self):
+        executor = ProcessPoolExecutor(self.workers)
+        #Start the workers now and not on the first request
+        list(executor.map(parseChunk, [[]] * self.workers))
+        return executor
+
+    def restartPool(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.startPool()
+        self.broken = False
+        with self.lock:
+            self.restarts += 1
+
+    def submit(self, strings):
+        #Returns a Future of the list of metars
+        future = Future()
+        self.queue.put((list(strings), future, time.monotonic()))
+        return future
+
+    def decode(self, strings):
+        return self.submit(strings).result()
+
+    def dispatch(self):
+        stopping = False
+        while not stopping:
+            request = self.queue.get()
+            if request is None:
+                break
+
+            batch = [request]
+            count = len(request[0])
+            deadline = time.monotonic() + self.maxDelay
+
+            while count < self.maxBatch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                count += len(request[0])
+
+            strings = [string for request in batch for string in request[0]]
+
+            if self.executor is None:
+                try:
+                    self.complete(batch, parseChunk(strings, self.decoder), None)
+                except Exception as e:
+                    self.complete(batch, None, e)
+            else:
+                try:
+                    if self.broken:
+                        self.restartPool()
+                    decoded = self.executor.submit(parseChunk, strings, self.decoder)
+                except Exception as e:
+                    #The pool broke since the last batch, or can't be restarted
+                    self.broken = True
+                    self.complete(batch, None, e)
+                else:
+                    decoded.add_done_callback(functools.partial(self.resolve, batch))
+
+    def resolve(self, batch, decoded):
+        try:
+            metars = decoded.result()
+        except Exception as e:
+            if isinstance(e, BrokenExecutor):
+                self.broken = True
+            self.complete(batch, None, e)
+        else:
+            self.complete(batch, metars, None)
+
+    def complete(self, batch, metars, error):
+        now = time.monotonic()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(batch)
+            for strings, future, enqueued in batch:
+                self.reports += len(strings)
+                self.latencies.append(now - enqueued)
+            if error is not None:
+                self.errors += len(batch)
+
+        position = 0
+        for strings, future, enqueued in batch:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(metars[position:position + len(strings)])
+            position += len(strings)
+
+    def stats(self):
+        #Latencies are in milliseconds, over the last latencyWindow requests
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            stats = {'requests': self.requests,
+                     'reports': self.reports,
+                     'batches': self.batches,
+                     'errors': self.errors,
+                     'restarts': self.restarts,
+                     'queued': self.queue.qsize(),
+                     'reportsPerBatch': self.reports / self.batches if self.batches else 0.0,
+                     'reportsPerSecond': self.reports / elapsed if elapsed else 0.0,
+                     'uptime': elapsed}
+
+        if latencies:
+            stats['latency'] = {'mean': sum(latencies) / len(latencies) * 1000,
+                                'p50': latencies[len(latencies) // 2] * 1000,
+                                'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+                                'max': latencies[-1] * 1000}
+        return stats
+
+    def close(self):
+        self.queue.put(None)
+        self.dispatcher.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DecodeHandler(http.server.BaseHTTPRequestHandler):
+    #POST /decode takes a JSON string (one report, answered with one metar),
+    #a JSON list of strings, or plain text with one report per line
+    #(answered with a list). GET /stats returns the service counters.
+    #Bodies over maxBody bytes are refused with 413 without being read.
+    protocol_version = 'HTTP/1.1'
+    maxBody = 16 << 20
+    #Headers and body go out in separate writes, Nagle would hold the body
+    #back until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        length = self.headers.get('Content-Length', '0')
+        if not (length.isascii() and length.isdigit()):
+            #The body can't be skipped, so the connection goes too
+            self.close_connection = True
+            return self.reply(400, {'error': 'bad Content-Length'})
+        if int(length) > self.maxBody:
+            self.close_connection = True
+            return self.reply(413, {'error': 'body over %d bytes' % self.maxBody})
+
+        body = self.rfile.read(int(length))
+
+        if self.path != '/decode':
+            return self.reply(404, {'error': 'not found'})
+
+        if self.headers.get_content_type() == 'application/json':
+            try:
+                value = json.loads(body)
+            except ValueError as e:
+                return self.reply(400, {'error': str(e)})
+        else:
+            value = [line.strip() for line in body.decode('ascii', 'replace').splitlines() if line.strip()]
 
-        trendList.append(trend)
+        single = isinstance(value, str)
+        strings = [value] if single else value
+        if not isinstance(strings, list) or not all(isinstance(string, str) for string in strings):
+            return self.reply(400, {'error': 'expected a report or a list of reports'})
 
-    if trendList:
-        metar['trends'] = trendList
+        try:
+            metars = self.server.service.decode(strings)
+        except Exception as e:
+            return self.reply(500, {'error': repr(e)})
 
-    parseRemark(tokens, metar)
+        self.reply(200, metars[0] if single else metars)
 
-    return metar
+def serveDecoder(service, host='127.0.0.1', port=0):
+    #Starts an HTTP decode server on a background thread. port=0 picks a
+    #free port, see server.server_address. Stop it with server.shutdown().
+    server = http.server.ThreadingHTTPServer((host, port), DecodeHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 def parse(url):
     with urllib.request.urlopen(url) as response:
         message = response.read()
         
-        string = message.splitlines(True)[1].decode("utf-8").strip() #Remove first line
+        string = reportFromStationFile(message)
 
         print(string)
         metar = parseString(string)
         pprint(metar)
-            
-def iterateAll():
-    with urllib.request.urlopen('ftp://tgftp.nws.noaa.gov/data/observations/metar/stations/') as files:
-        listing = files.read().splitlines(True)
-        
-        forbidden = ['A302.TXT', 'AAXX.TXT', 'AGGG.TXT', 'AGGM.TXT', 'AK15.TXT',
-                     'ATAR.TXT', 'B635.TXT']
 
-        for l in listing:
-            filename = l.split()[-1].decode('ascii')
+def printMetar(filename, metar):
+    pprint(metar)
+    print("-----")
 
-            if filename in forbidden:
-                continue
-            
-            #if filename[0:2] != "ES":
-            #    continue
-            
-            pprint(parse("ftp://tgftp.nws.noaa.gov/data/observations/metar/stations/%s" % filename))
-            print("-----")
+def iterateAll(sink=printMetar, workers=16):
+    #Reports that don't decode fully are kept, with their unparsed groups
+    errorCounts = Counter()
+    decoder = functools.partial(parseLenient, errorCounts=errorCounts)
+
+    with StationFetcher() as fetcher:
+        filenames = stationFilenames(fetcher.fetch(stationsUrl))
+
+        #filenames = [filename for filename in filenames if filename[0:2] == "ES"]
+
+        failures = fetchAll(sink, stationsUrl, filenames, workers, fetcher, decoder)
+
+    print(dict(errorCounts))
+    return failures
+
+def iterateCycles(sink=printMetar, hours=None):
+    errorCounts = Counter()
+    decoder = functools.partial(parseLenient, errorCounts=errorCounts)
+
+    failures = fetchCycles(sink, cyclesUrl, cycleFilenames(hours), decoder=decoder)
+
+    print(dict(errorCounts))
+    return failures
+
+def watch(sink=printMetar, cacheDirectory='stations', interval=300, prefixes=()):
+    #Command line watch mode, passes new reports to sink as they arrive.
+    #Waits on the watcher too, so an error that ends it is raised here
+    #instead of leaving the subscription waiting forever.
+    async def run():
+        hub = ObservationHub()
+        subscription = hub.subscribe(prefixes, policy='block')
+        watcher = asyncio.ensure_future(watchStations(hub, cacheDirectory, interval, decoder=parseLenient))
+
+        try:
+            while True:
+                getter = asyncio.ensure_future(subscription.get())
+                done, pending = await asyncio.wait((getter, watcher), return_when=asyncio.FIRST_COMPLETED)
+
+                if getter not in done:
+                    getter.cancel()
+                    return watcher.result()
+
+                filename, metar = getter.result()
+                sink(filename, metar)
+        finally:
+            watcher.cancel()
+
+    asyncio.run(run())
 
 import unittest
+import tempfile
+import pickle
+import unittest.mock
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+def serveFixtures(directory):
+    #Local stand-in for the NOAA server, serving a fixture directory.
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def writeStationFiles(directory, reports, date='2017/02/16 05:20'):
+    for filename, report in reports.items():
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write('%s\n%s\n' % (date, report))
 
 class DecometTest(unittest.TestCase):
 
@@ -741,6 +3653,1023 @@ class DecometTest(unittest.TestCase):
 
         self.assertEqual(metar['remark'], 'FOO BAR')
 
+    def testParseString(self):
+        metar = parseString('ESSL 160520Z 00000KT 0100 R11/0550 R29/0300V0450N FG VV000 01/01 Q1026')
+
+        self.assertEqual(metar['airport'], 'ESSL')
+        self.assertEqual(metar['time'], '05:20')
+        self.assertEqual(metar['wind'], {'direction': '000', 'speed': '00', 'unit': 'KT'})
+        self.assertEqual(len(metar['visibility']), 3)
+        self.assertEqual(metar['visibility'][2]['runways']['29']['varying']['to'], '0450')
+        self.assertEqual(metar['precipitation']['type'], 'fog')
+        self.assertEqual(metar['temperature'], '1')
+        self.assertEqual(metar['QNH'], '1026')
+
+        metar = parseString('ESSA 161150Z VRB03KT CAVOK M02/M08 Q1032 NOSIG RMK AO2')
+
+        self.assertTrue(metar['wind']['variable'])
+        self.assertTrue(metar['visibility'][0]['CAVOK'])
+        self.assertEqual(metar['trends'], [{'type': 'No significant change expected'}])
+        self.assertEqual(metar['remark'], 'AO2')
+
+    def testParseMany(self):
+        strings = ['ES%02d 160520Z 00000KT 0100 FG 01/01 Q1026' % i for i in range(7)]
+        expected = [parseString(string) for string in strings]
+
+        self.assertEqual(list(parseMany(strings, workers=1, chunkSize=3)), expected)
+        self.assertEqual(list(parseMany(iter(strings), workers=2, chunkSize=3)), expected)
+
+        unordered = sorted(parseMany(strings, workers=2, chunkSize=2, ordered=False))
+        self.assertEqual([index for index, metar in unordered], list(range(7)))
+        self.assertEqual([metar for index, metar in unordered], expected)
+
+        self.assertEqual(list(parseMany([], workers=2)), [])
+
+    def testThreadSafety(self):
+        reports = ['E%03d %02d%02d20Z %03d%02dKT %04d -SHRA FEW0%02d BKN1%02d %02d/M01 Q1%03d TEMPO 0600/0700 0500 RMK X' %
+                   (number, number % 28 + 1, number % 24, number % 36 * 10, number % 30, number * 10 % 9999,
+                    number % 90 + 10, number % 90 + 10, number % 30, number % 40) for number in range(400)]
+        reports += ['BAD 16052', 'ESSL 160520Z 00000KT 0100 XX FG']
+        expected = [parseLenient(report) for report in reports]
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            self.assertEqual(list(parseMany(reports, workers=8, chunkSize=7, decoder=parseLenient, backend='thread')), expected)
+            self.assertEqual(sorted(parseMany(reports, workers=8, chunkSize=7, ordered=False, decoder=parseLenient, backend='thread'),
+                                    key=lambda item: item[0]), list(enumerate(expected)))
+            #Any decoder works, nothing is pickled
+            self.assertEqual(list(parseMany(reports[:10], workers=2, decoder=lambda string: len(string), backend='thread')),
+                             [len(report) for report in reports[:10]])
+
+            #Shared caches and counters used from many threads at once
+            cache = MetarCache(maxSize=64, decoder=parseLenient)
+            errorCounts = Counter()
+            decoder = functools.partial(parseLenient, errorCounts=errorCounts)
+            index = WeatherIndex()
+
+            def work(offset):
+                for report in reports[offset:] + reports[:offset]:
+                    self.assertEqual(cache(report), expected[reports.index(report)])
+                    metar = decoder(report)
+                    if 'airport' in metar:
+                        index.add(metar)
+                    if report != 'BAD 16052':
+                        parseLazy(report)
+
+            with profiling() as stats:
+                with ThreadPoolExecutor(8) as executor:
+                    list(executor.map(work, range(0, 400, 50)))
+
+            self.assertEqual(cache.hits + cache.misses, 8 * len(reports))
+            self.assertLessEqual(len(cache), 64)
+            #Cache misses, the partial decoder and parseLazy
+            self.assertEqual(stats.snapshot()['groups']['parseAirportCode']['calls'], cache.misses + 8 * len(reports) * 2 - 8)
+            self.assertEqual(len(index), 402)
+
+            #Registering a group type while other threads decode
+            with ThreadPoolExecutor(4) as executor:
+                futures = [executor.submit(lambda: [parseString(report) for report in reports[:400]]) for _ in range(4)]
+                for _ in range(20):
+                    buildDispatch()
+                for future in futures:
+                    self.assertEqual(future.result(), expected[:400])
+        finally:
+            sys.setswitchinterval(interval)
+
+        with self.assertRaises(ValueError):
+            parseMany(reports, backend='fiber')
+
+    def testReadArchive(self):
+        reports = ['ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005']
+        plain = '\n'.join(reports) + '\n'
+        noaa = '2017/02/16 05:20\n%s\n\n2017/02/02 03:00\n%s\n' % tuple(reports)
+        expected = [parseString(report) for report in reports]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name, opener, content in [('plain.txt', open, plain),
+                                          ('noaa.txt', open, noaa),
+                                          ('reports.gz', gzip.open, plain),
+                                          ('reports.bz2', bz2.open, noaa),
+                                          ('reports.xz', lzma.open, plain),
+                                          ('empty.txt', open, '')]:
+                path = os.path.join(directory, name)
+                with opener(path, 'wb') as f:
+                    f.write(content.encode('ascii'))
+
+                if content:
+                    self.assertEqual(list(readReports(path)), reports)
+                    self.assertEqual(list(readArchive(path)), expected)
+                else:
+                    self.assertEqual(list(readArchive(path)), [])
+
+    def testReprocessArchives(self):
+        reports = ['E%03d %02d%02d20Z %03d%02dKT %04d FEW0%02d %02d/M01 Q1%03d' %
+                   (number, number % 28 + 1, number % 24, number % 36 * 10, number % 30, number * 10 % 9999,
+                    number % 90 + 10, number % 30, number % 40) for number in range(300)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for name, opener, chunk in [('2016.txt', open, reports[:200]), ('2017.gz', gzip.open, reports[200:])]:
+                paths.append(os.path.join(directory, name))
+                with opener(paths[-1], 'wb') as f:
+                    f.write(''.join('2017/02/16 05:20\n%s\n\n' % report for report in chunk).encode('ascii'))
+
+            outputDirectory = os.path.join(directory, 'output')
+            shards = planShards(paths, shardSize=4096)
+            self.assertGreater(len(shards), 3)
+            self.assertEqual(sum(shard['path'] == os.path.abspath(paths[1]) for shard in shards), 1)
+
+            #Byte ranges split the reports without losing or repeating any
+            self.assertEqual([string for shard in shards[:-1] for string in readReports(shard['path'], shard['start'], shard['end'])],
+                             reports[:200])
+
+            updates = []
+            result = reprocessArchives(paths, outputDirectory, workers=2, shardSize=4096, progress=updates.append)
+            self.assertEqual((result['completed'], result['resumed'], result['reports']), (len(shards), 0, 300))
+            self.assertEqual(len(updates), len(shards))
+            self.assertEqual(updates[-1]['completed'], len(shards))
+            self.assertGreater(updates[-1]['reportsPerSecond'], 0)
+
+            def decoded():
+                return [metar for name in sorted(os.listdir(outputDirectory)) if name.endswith('.jsonl')
+                        for metar in readJsonLines(os.path.join(outputDirectory, name))]
+            self.assertEqual(decoded(), json.loads(json.dumps([parseLenient(report) for report in reports])))
+
+            #An interrupted run: one shard lost, another never written
+            with open(os.path.join(outputDirectory, 'manifest.json')) as f:
+                manifest = json.load(f)
+            del manifest['completed']['shard-000001.jsonl']
+            with open(os.path.join(outputDirectory, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            os.remove(os.path.join(outputDirectory, 'shard-000002.jsonl'))
+
+            result = reprocessArchives(paths, outputDirectory, workers=1, shardSize=4096, progress=None)
+            self.assertEqual((result['resumed'], result['completed']), (len(shards) - 2, len(shards)))
+            self.assertEqual(result['reports'], sum(1 for shard in shards[1:3]
+                                                    for report in readReports(shard['path'], shard['start'], shard['end'])))
+            self.assertEqual(len(decoded()), 300)
+
+            #A changed input is done again
+            with gzip.open(paths[1], 'ab') as f:
+                f.write(b'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026\n')
+            result = reprocessArchives(paths, outputDirectory, workers=1, shardSize=4096, decoder=parseString, progress=None)
+            self.assertEqual((result['resumed'], result['reports'], result['failed']), (len(shards) - 1, 101, {}))
+
+            #A different plan doesn't leave the outputs of the old one behind
+            result = reprocessArchives(paths, outputDirectory, workers=1, shardSize=1 << 20, progress=None)
+            self.assertEqual((result['shards'], result['resumed']), (2, 0))
+            self.assertEqual(sorted(os.listdir(outputDirectory)), ['manifest.json', 'shard-000000.jsonl', 'shard-000001.jsonl'])
+            self.assertEqual(len(decoded()), 301)
+
+    def testReportWriters(self):
+        metars = [parseString('ESSL 160520Z 00000KT 0100 R11/0550 FG VV000 01/01 Q1026'),
+                  parseString('AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005 NOSIG'),
+                  parseLenient('BAD 16052')]
+
+        with tempfile.TemporaryDirectory() as directory:
+            #Neither format has tuples, the (code, token) pairs of parseLenient come back as lists
+            jsonMetars = json.loads(json.dumps(metars))
+
+            for writer, reader, name, expected in [(JsonLinesWriter, readJsonLines, 'reports.jsonl', jsonMetars),
+                                                   (BinaryWriter, readBinary, 'reports.bin', jsonMetars)]:
+                path = os.path.join(directory, name)
+
+                with writer(path, batchSize=2) as output:
+                    output.write(metars[0])
+                    output.sink('AGGM.TXT', metars[1])
+                    self.assertEqual(output.count, 2)
+                    output.writeMany(metars[2:])
+
+                self.assertEqual(output.count, 3)
+                self.assertEqual(list(reader(path)), expected)
+
+            #A frame is one MessagePack array of metars
+            with open(path, 'rb') as f:
+                data = f.read()
+            length, = frameHeader.unpack_from(data, len(binaryMagic))
+            self.assertEqual(data[len(binaryMagic) + frameHeader.size], 0x92)
+            self.assertEqual(unpackValue(data[len(binaryMagic) + frameHeader.size:][:length]), (jsonMetars[:2], length))
+
+            values = ['', 'x' * 40, 'y' * 300, 'z' * 70000, list(range(20)), {str(i): i for i in range(20)},
+                      None, True, False, -1, -33, 127, 128, 1 << 40, -1.5, 'åäö', [(1, 'a')]]
+            packed = bytearray()
+            packValue(values, packed)
+            self.assertEqual(unpackValue(bytes(packed)), (json.loads(json.dumps(values)), len(packed)))
+            with self.assertRaises(TypeError):
+                packValue({1.5j}, bytearray())
+
+            with open(path, 'ab') as f:
+                f.write(b'\xff\x00\x00\x00{')
+            with self.assertRaises(ValueError):
+                list(readBinary(path))
+
+            #Malformed frames raise ValueError, nothing is evaluated
+            for frame in [b'\x91', b'\xc1', b'\xa5abc', b'\x81\xa1a', b'\xa1a', b'\x91\xa1a\xc0']:
+                with open(path, 'wb') as f:
+                    f.write(binaryMagic + frameHeader.pack(len(frame)) + frame)
+                with self.assertRaises(ValueError):
+                    list(readBinary(path))
+
+            with self.assertRaises(ValueError):
+                list(readBinary(os.path.join(directory, 'reports.jsonl')))
+
+            #Compressed JSON Lines read back through readLines
+            path = os.path.join(directory, 'reports.jsonl.gz')
+            with gzip.open(path, 'wb') as f, JsonLinesWriter(f) as output:
+                output.writeMany(metars)
+            self.assertEqual(list(readJsonLines(path)), jsonMetars)
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def testParseColumns(self):
+        columns = parseColumns(['ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                                'EGLL 161150Z AUTO 24015G25KT 9999 -SHRA FEW015 BKN030CB M02/M08 Q////',
+                                'AGGM 020300Z VRB05MPS 25KM 33/25 Q1005'])
+
+        self.assertEqual(list(columns['airport']), ['ESSL', 'EGLL', 'AGGM'])
+        self.assertEqual(list(columns['day']), [16, 16, 2])
+        self.assertEqual(list(columns['minutes']), [320, 710, 180])
+        self.assertEqual(list(columns['automatic']), [False, True, False])
+
+        self.assertEqual(columns['windDirection'][1], 240)
+        self.assertTrue(np.isnan(columns['windDirection'][2]))
+        self.assertTrue(columns['windVariable'][2])
+        self.assertEqual(columns['windGust'][1], 25)
+        self.assertTrue(np.isnan(columns['windGust'][0]))
+        self.assertEqual(list(columns['windUnit']), [0, 0, 1])
+
+        self.assertEqual(list(columns['visibility']), [100, 10000, 25000])
+
+        self.assertEqual(precipitationCodes[columns['precipitationType'][0]], 'fog')
+        self.assertEqual(intensityCodes[columns['precipitationIntensity'][1]], 'light')
+        self.assertEqual(descriptionCodes[columns['precipitationDescription'][1]], 'showers')
+        self.assertEqual(columns['precipitationType'][2], -1)
+
+        self.assertEqual(list(columns['cloudCoverage'][1]), [0, 2, -1, -1])
+        self.assertEqual(list(columns['cloudHeight'][1][:2]), [1500, 3000])
+        self.assertEqual(list(columns['cumulonimbus'][1][:2]), [False, True])
+
+        self.assertEqual(list(columns['temperature']), [1, -2, 33])
+        self.assertEqual(columns['QNH'][0], 1026)
+        self.assertTrue(np.isnan(columns['QNH'][1]))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def testNormalizeMetars(self):
+        strings = ['ESSL 160520Z 00000KT 0100 FG VV003 M01/M02 Q1026',
+                   'UUEE 160520Z 24010G15MPS 25KM BKN020 OVC100 05/01 Q////',
+                   'EGLL 160520Z VRB03KT CAVOK 12/09 Q1012',
+                   'EDDF 160520Z 24020KT 9999 FEW040 10/05 Q1020',
+                   'LFPG 160520Z']
+        array = parseNormalized(strings, maxClouds=2, decoder=parseLenient)
+
+        self.assertEqual(list(array['airport']), ['ESSL', 'UUEE', 'EGLL', 'EDDF', 'LFPG'])
+        self.assertEqual(array['windSpeed'][0], 0)
+        self.assertAlmostEqual(array['windSpeed'][1], 10)
+        self.assertAlmostEqual(array['windGust'][1], 15)
+        self.assertAlmostEqual(array['windSpeed'][3], 20 * 0.514444, places=4)
+        self.assertTrue(array['windVariable'][2])
+        self.assertTrue(np.isnan(array['windDirection'][2]))
+        self.assertEqual(list(array['visibility'][:4]), [100, 25000, 10000, 10000])
+        self.assertEqual(list(array['CAVOK']), [False, False, True, False, False])
+        self.assertAlmostEqual(array['verticalVisibility'][0], 91.44, places=3)
+        self.assertAlmostEqual(array['cloudHeight'][1][1], 3048, places=2)
+        self.assertTrue(np.isnan(array['cloudHeight'][3][1]))
+        self.assertAlmostEqual(array['temperature'][0], 272.15, places=3)
+        self.assertAlmostEqual(array['dewPoint'][1], 274.15, places=3)
+        self.assertEqual(array['QNH'][0], 102600)
+        self.assertTrue(np.isnan(array['QNH'][1]))
+        self.assertTrue(np.isnan(array['windSpeed'][4]))
+        self.assertTrue(np.isnan(array['visibility'][4]))
+
+        self.assertEqual(list(array['cloudCoverage'][1]), [coverageCodes.index('broken'), coverageCodes.index('overcast')])
+        self.assertEqual(len(normalizeMetars([])), 0)
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def testDerivedMetrics(self):
+        strings = ['ESSL 160520Z 00000KT 0100 FG VV003 M01/M02 Q1026',
+                   'ESSA 160520Z 24010G15MPS 9999 FEW005 BKN020 OVC100 20/10 Q1005',
+                   'EGLL 160520Z VRB03KT CAVOK 12/12 Q1012',
+                   'EDDF 160520Z 33020KT 4000 BR SCT008 BKN012 10/05 Q1020',
+                   'LFPG 160520Z']
+        derived = derivedMetrics(parseNormalized(strings, decoder=parseLenient), {'ESSA': 270, 'EGLL': 90, 'EDDF': 250})
+
+        self.assertEqual([flightCategoryCodes[code] if code >= 0 else None for code in derived['flightCategory']],
+                         ['LIFR', 'MVFR', 'VFR', 'IFR', None])
+        self.assertAlmostEqual(derived['ceiling'][0], 300 * feet, places=3)
+        self.assertAlmostEqual(derived['ceiling'][1], 2000 * feet, places=3)
+        self.assertTrue(np.isnan(derived['ceiling'][2]))
+        self.assertAlmostEqual(derived['ceiling'][3], 1200 * feet, places=3)
+
+        self.assertAlmostEqual(derived['relativeHumidity'][2], 100, places=3)
+        self.assertAlmostEqual(derived['relativeHumidity'][1], 52.5, places=0)
+
+        self.assertAlmostEqual(derived['crosswind'][1], 10 * np.sin(np.radians(30)), places=4)
+        self.assertAlmostEqual(derived['headwind'][1], 10 * np.cos(np.radians(30)), places=4)
+        self.assertAlmostEqual(derived['crosswind'][2], 3 * 0.514444, places=4)
+        self.assertAlmostEqual(derived['headwind'][3], 20 * 0.514444 * np.cos(np.radians(80)), places=4)
+        self.assertTrue(np.isnan(derived['crosswind'][0]))
+
+        #Category limits, in feet and statute miles. The decoder has no SM
+        #visibility groups, so those are set on the array.
+        limits = ['KJFK 160520Z 24010KT 9999 BKN030 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 BKN031 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 BKN010 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 BKN009 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 BKN005 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 BKN004 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 FEW050 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 FEW050 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 FEW050 10/05 A2992',
+                   'KJFK 160520Z 24010KT 9999 FEW050 10/05 A2992']
+        normalized = parseNormalized(limits)
+        normalized['visibility'][6:] = np.array([5, 5.5, 3, 2.75]) * statuteMile
+        self.assertEqual([flightCategoryCodes[code] for code in derivedMetrics(normalized)['flightCategory']],
+                         ['MVFR', 'VFR', 'MVFR', 'IFR', 'IFR', 'LIFR', 'MVFR', 'VFR', 'MVFR', 'IFR'])
+
+        engine = DerivedMetrics({'ESSA': 270}, maxSize=4)
+        first = engine(strings)
+        self.assertEqual((engine.hits, engine.misses), (0, 5))
+        self.assertEqual(first['crosswind'][1], derived['crosswind'][1])
+        np.testing.assert_array_equal(first['flightCategory'], derived['flightCategory'])
+
+        again = engine(strings[1:] + strings[1:2])
+        self.assertEqual((engine.hits, engine.misses), (5, 5))
+        self.assertEqual(list(again['airport']), ['ESSA', 'EGLL', 'EDDF', 'LFPG', 'ESSA'])
+        self.assertEqual(len(engine.cache), 4)
+        self.assertEqual(len(engine([])), 0)
+
+        fromGenerator = engine(string for string in strings[1:3])
+        self.assertEqual(list(fromGenerator['airport']), ['ESSA', 'EGLL'])
+
+    def testMetarRecord(self):
+        strings = ['ESSL 160520Z 00000KT 0100 R11/0550 R29/0300V0450N FG VV000 01/01 Q1026',
+                   'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q0995',
+                   'EGLL 161150Z AUTO 24015G25KT 350V050 9999 -SHRA BKN030CB M02/M08 Q//// 74692225 '
+                   'TEMPO 1200/1300 10044G55KT 0100 +SHRA BKN050CB FM1325 20010MPS CAVOK NSC RMK AO2',
+                   'UUEE 160520Z 24010MPS 10KM BKN020 M05/M07 Q0998 BECMG 05KM',
+                   'UUEE 160550Z 24010MPS 05KM BKN020 M05/M07 Q0998']
+
+        for string in strings:
+            self.assertEqual(parseRecord(string).toDict(), parseString(string))
+        self.assertEqual(parseRecord(strings[3]).toDict()['visibility'][0]['distance'], '10KM')
+        self.assertEqual(parseRecord(strings[4]).visibility[0].distance, 5000)
+
+        record = parseRecord(strings[2])
+        self.assertEqual(record.time, 11 * 60 + 50)
+        self.assertEqual(record.wind.direction, 240)
+        self.assertEqual(record.wind.gust, 25)
+        self.assertEqual(record.visibility[0].distance, 10000)
+        self.assertEqual(record.clouds[0].height, 3000)
+        self.assertTrue(record.clouds[0].cumulonimbus)
+        self.assertEqual(record.temperature, -2)
+        self.assertEqual(record.QNH, '<unknown>')
+        self.assertEqual(record.trends[0].end, 13 * 60)
+        self.assertEqual(record.trends[1].wind.unit, 'MPS')
+
+        self.assertEqual(parseRecord(strings[1]).visibility[0].distance, 25000)
+        self.assertEqual(parseRecord(strings[1]).toDict()['QNH'], '0995')
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        self.assertEqual(pickle.loads(pickle.dumps(record)).toDict(), record.toDict())
+
+    def testDeltaEncoder(self):
+        strings = ['ESSL 160520Z 00000KT 0100 FG VV001 01/01 Q1026',
+                   'ESSL 160520Z 00000KT 0100 FG VV001 01/01 Q1026',
+                   'ESSL 160550Z 05004KT 0300 BR BKN003 01/01 Q1027 TEMPO 0600/0700 9999',
+                   'ESSL 160620Z 05004KT 240V300 0300 BR BKN003 OVC010 01/01 Q1027',
+                   'ESSA 160620Z 27010KT CAVOK 05/01 Q1010']
+        metars = [parseString(string) for string in strings]
+
+        deltas = []
+        encoder = DeltaEncoder(deltas.append)
+        for metar in metars:
+            encoder.sink(metar['airport'] + '.TXT', metar)
+
+        self.assertEqual([(delta['airport'], delta['sequence']) for delta in deltas],
+                         [('ESSL', 0), ('ESSL', 1), ('ESSL', 2), ('ESSA', 0)])
+        self.assertEqual(deltas[1]['set']['wind.direction'], '050')
+        self.assertEqual(deltas[1]['set']['QNH'], '1027')
+        self.assertEqual(len(deltas[1]['set']['trends']), 1)
+        self.assertNotIn('temperature', deltas[1]['set'])
+        self.assertEqual(deltas[2]['set']['wind.varying'], {'from': '240', 'to': '300'})
+        self.assertEqual(deltas[2]['unset'], ['trends'])
+        self.assertNotIn('visibility', deltas[2]['set'])
+
+        applier = DeltaApplier()
+        #Deltas survive a JSON round trip
+        rebuilt = [applier.apply(json.loads(json.dumps(delta))) for delta in deltas]
+        self.assertEqual(rebuilt, [metars[0], metars[2], metars[3], metars[4]])
+        #Earlier reports are not changed by later deltas
+        self.assertEqual(rebuilt[0], metars[0])
+        self.assertNotIn('varying', rebuilt[1]['wind'])
+
+        applier = DeltaApplier()
+        applier.apply(deltas[0])
+        with self.assertRaises(ValueError):
+            applier.apply(deltas[2])
+        self.assertEqual(applier.apply(encoder.full('ESSL')), metars[3])
+
+    def testDecodeService(self):
+        strings = ['ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005',
+                   'BAD 16052']
+
+        with DecodeService(workers=0, maxDelay=0.05) as service:
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda i: service.decode(strings[i % 3:]), range(24)))
+
+            for i, metars in enumerate(results):
+                self.assertEqual(metars, [parseLenient(string) for string in strings[i % 3:]])
+
+            stats = service.stats()
+            self.assertEqual(stats['requests'], 24)
+            self.assertEqual(stats['reports'], 48)
+            #Concurrent requests share batches
+            self.assertLess(stats['batches'], 24)
+            self.assertGreater(stats['latency']['max'], 0)
+
+            server = serveDecoder(service)
+            connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+            try:
+                def request(method, path, body=None, contentType='application/json'):
+                    connection.request(method, path, body, {'Content-Type': contentType})
+                    response = connection.getresponse()
+                    return response.status, json.loads(response.read())
+
+                self.assertEqual(request('POST', '/decode', json.dumps(strings[0])), (200, parseLenient(strings[0])))
+                status, metars = request('POST', '/decode', json.dumps(strings))
+                self.assertEqual(metars, json.loads(json.dumps([parseLenient(string) for string in strings])))
+                status, metars = request('POST', '/decode', '\n'.join(strings[:2]) + '\n\n', 'text/plain')
+                self.assertEqual([metar['airport'] for metar in metars], ['ESSL', 'AGGM'])
+
+                self.assertEqual(request('POST', '/decode', '{"reports":')[0], 400)
+                self.assertEqual(request('POST', '/decode', '[1, 2]')[0], 400)
+                self.assertEqual(request('GET', '/other')[0], 404)
+
+                status, stats = request('GET', '/stats')
+                self.assertEqual(stats['reports'], 48 + 1 + 3 + 2)
+
+                def rawStatus(length):
+                    #A fresh connection each, the server closes it after these
+                    raw = http.client.HTTPConnection(*server.server_address, timeout=5)
+                    try:
+                        raw.putrequest('POST', '/decode')
+                        raw.putheader('Content-Length', length)
+                        raw.endheaders()
+                        return raw.getresponse().status
+                    finally:
+                        raw.close()
+
+                self.assertEqual(rawStatus('-1'), 400)
+                self.assertEqual(rawStatus('ten'), 400)
+                self.assertEqual(rawStatus(str(DecodeHandler.maxBody + 1)), 413)
+            finally:
+                connection.close()
+                server.shutdown()
+                server.server_close()
+
+        #A process pool, and a decoder that fails the whole batch
+        with DecodeService(workers=1) as service:
+            self.assertEqual(service.decode(strings[:2]), [parseLenient(string) for string in strings[:2]])
+
+            #A worker that dies fails the pending requests instead of hanging
+            #them, and the next batch gets a fresh pool
+            for process in list(service.executor._processes.values()):
+                process.kill()
+                process.join()
+            with self.assertRaises(BrokenExecutor):
+                service.submit(strings[:2]).result(timeout=30)
+            self.assertEqual(service.submit(strings[:2]).result(timeout=30), [parseLenient(string) for string in strings[:2]])
+            self.assertEqual(service.stats()['restarts'], 1)
+
+        with DecodeService(workers=0, decoder=parseString) as service:
+            with self.assertRaises(ValueError):
+                service.decode(strings)
+            self.assertEqual(service.stats()['errors'], 1)
+
+    def testParseLazy(self):
+        string = 'UUEE 160520Z 24010G15MPS 25KM +SHSN BKN020 M05/M07 Q0998 TEMPO 0600/0700 0500 RMK QFE734'
+        metar = parseLazy(string)
+
+        self.assertEqual((metar['airport'], metar['time']), ('UUEE', '05:20'))
+        self.assertEqual(metar.tokens[0], '24010G15MPS')
+
+        self.assertEqual(metar['wind']['speed in gusts'], '15')
+        self.assertEqual(metar.tokens[0], '25KM')
+
+        self.assertEqual(metar.get('QNH'), '0998')
+        self.assertEqual(metar.tokens[0], 'TEMPO')
+        self.assertNotIn('runway', metar)
+
+        self.assertEqual(metar.toDict(), parseString(string))
+        self.assertEqual(dict(metar), parseString(string))
+        self.assertIsNone(metar.order)
+
+        #Decoding stops at a token no group takes, as in parseString
+        string = 'ESSL 160520Z 00000KT 0100 XX FG 01/01 Q1026'
+        self.assertEqual(parseLazy(string).get('temperature'), None)
+        self.assertEqual(parseLazy(string).toDict(), parseString(string))
+
+        self.assertRaises(ValueError, parseLazy, 'BAD 16052')
+
+    def testFetchAll(self):
+        reports = {'ESSL.TXT': 'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'AGGM.TXT': 'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005',
+                   'BAD.TXT': 'BAD 16052'}
+
+        with tempfile.TemporaryDirectory() as directory:
+            writeStationFiles(directory, reports)
+            server = serveFixtures(directory)
+            url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+            try:
+                fetcher = StationFetcher(timeout=5, retries=0)
+                self.assertEqual(sorted(stationFilenames(fetcher.fetch(url))), sorted(reports))
+
+                metars = {}
+                failures = fetchAll(lambda filename, metar: metars.__setitem__(filename, metar), url,
+                                    workers=2, fetcher=fetcher)
+
+                self.assertEqual(metars, {filename: parseString(reports[filename]) for filename in ['ESSL.TXT', 'AGGM.TXT']})
+                self.assertEqual(list(failures), ['BAD.TXT'])
+                self.assertIsInstance(failures['BAD.TXT'], ValueError)
+
+                failures = fetchAll(lambda filename, metar: None, url, ['MISSING.TXT'], fetcher=fetcher)
+                self.assertEqual(failures['MISSING.TXT'].code, 404)
+            finally:
+                fetcher.close()
+                server.shutdown()
+                server.server_close()
+
+    def testFetchCycles(self):
+        cycle = ('2017/02/16 05:00\n'
+                 'ESSL 160450Z 00000KT 0100 FG 01/01 Q1026\n'
+                 '\n'
+                 '2017/02/16 05:00\n'
+                 'AGGM 160500Z 09005KT 25KM HZ FEW020\n'
+                 '     SCT300 33/25 Q1005\n'
+                 '\n'
+                 '2017/02/16 05:05\n'
+                 'BAD 16052\n'
+                 '\n'
+                 '2017/02/16 05:20\n'
+                 'ESSL 160520Z 00000KT 0200 FG 01/01 Q1026\n')
+
+        self.assertEqual(list(cycleReports(cycle.encode('ascii').splitlines(True))),
+                         ['ESSL 160450Z 00000KT 0100 FG 01/01 Q1026',
+                          'AGGM 160500Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005',
+                          'BAD 16052',
+                          'ESSL 160520Z 00000KT 0200 FG 01/01 Q1026'])
+        self.assertEqual(cycleFilenames([0, 5]), ['00Z.TXT', '05Z.TXT'])
+        self.assertEqual(len(cycleFilenames()), 24)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, '05Z.TXT'), 'w') as f:
+                f.write(cycle)
+            with open(os.path.join(directory, '06Z.TXT'), 'w') as f:
+                f.write('2017/02/16 06:00\nEKCH 160600Z 27005KT CAVOK 10/05 Q1020\n')
+
+            server = serveFixtures(directory)
+            urls = ['http://127.0.0.1:%d/' % server.server_address[1], 'file://%s/' % directory]
+
+            try:
+                with StationFetcher(timeout=5, retries=0) as fetcher:
+                    for url in urls:
+                        metars = []
+                        failures = fetchCycles(lambda filename, metar: metars.append((filename, metar['airport'], metar['time'])),
+                                               url, ['05Z.TXT', '04Z.TXT', '06Z.TXT'], fetcher)
+
+                        self.assertEqual(metars, [('05Z.TXT', 'ESSL', '04:50'),
+                                                  ('05Z.TXT', 'AGGM', '05:00'),
+                                                  ('05Z.TXT', 'ESSL', '05:20'),
+                                                  ('06Z.TXT', 'EKCH', '06:00')])
+                        self.assertEqual(sorted(failures), ['04Z.TXT', 'BAD 16052'])
+                        self.assertIsInstance(failures['BAD 16052'], ValueError)
+
+                    #The kept-alive connection still works after a partly read stream
+                    with fetcher.stream(urls[0] + '05Z.TXT') as response:
+                        response.readline()
+                    self.assertEqual(fetcher.fetch(urls[0] + '06Z.TXT')[:16], b'2017/02/16 06:00')
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def testWatchStations(self):
+        reports = {'ESSL.TXT': 'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'ESSA.TXT': 'ESSA 160520Z 27010KT CAVOK 05/01 Q1010',
+                   'AGGM.TXT': 'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005'}
+
+        async def run(url, cacheDirectory, fetcher):
+            hub = ObservationHub()
+            swedish = hub.subscribe(['ES'])
+            newest = hub.subscribe(maxSize=1, policy='dropOldest')
+            oldest = hub.subscribe(maxSize=1, policy='dropNewest')
+
+            stats = await watchStations(hub, cacheDirectory, 0, url, 2, fetcher, rounds=2)
+            self.assertEqual(stats['unchanged'], 3)
+            self.assertEqual(hub.published, 3)
+
+            airports = sorted([(await swedish.get())[1]['airport'] for _ in range(2)])
+            self.assertEqual(airports, ['ESSA', 'ESSL'])
+            self.assertTrue(swedish.queue.empty())
+
+            self.assertEqual((newest.dropped, oldest.dropped), (2, 2))
+            self.assertEqual(newest.queue.qsize(), 1)
+
+            #Only the station that changed is published again
+            newest.close()
+            path = os.path.join(directory, 'ESSL.TXT')
+            mtime = os.stat(path).st_mtime
+            writeStationFiles(directory, {'ESSL.TXT': 'ESSL 160550Z 00000KT 0100 FG 01/01 Q1027'})
+            os.utime(path, (mtime + 60, mtime + 60))
+
+            stats = await watchStations(hub, cacheDirectory, 0, url, 2, fetcher, rounds=1)
+            self.assertEqual(stats['fetched'], 1)
+            filename, metar = await swedish.get()
+            self.assertEqual((filename, metar['QNH']), ('ESSL.TXT', '1027'))
+            self.assertEqual(newest.queue.qsize(), 1)
+
+            stats = await watchStations(hub, cacheDirectory, 0, url + 'missing/', 2, fetcher, rounds=1)
+            self.assertEqual(stats['error'].code, 404)
+
+            with self.assertRaises(ValueError):
+                hub.subscribe(policy='drop')
+
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cacheDirectory:
+            writeStationFiles(directory, reports)
+            server = serveFixtures(directory)
+
+            try:
+                with StationFetcher(timeout=5, retries=0) as fetcher:
+                    asyncio.run(run('http://127.0.0.1:%d/' % server.server_address[1], cacheDirectory, fetcher))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def testWatchRaisesWatcherErrors(self):
+        #A corrupt index.json ends the watcher, watch() must not hang
+        async def publishThenFail(hub, cacheDirectory, interval, decoder):
+            await hub.publish('ESSL.TXT', parseString('ESSL 160520Z 00000KT 0100 FG 01/01 Q1026'))
+            raise json.JSONDecodeError('Expecting value', '', 0)
+
+        received = []
+        with unittest.mock.patch('decomet.watchStations', publishThenFail):
+            with self.assertRaises(json.JSONDecodeError):
+                watch(lambda filename, metar: received.append(filename), interval=0)
+
+        self.assertEqual(received, ['ESSL.TXT'])
+
+    def testStationFilenames(self):
+        listing = (b'-rw-r--r--   1 ftp  ftp  90 Feb 16 05:20 AAAA.TXT\r\n'
+                   b'-rw-r--r--   1 ftp  ftp  91 Feb 16 05:25 ESSL.TXT\r\n')
+        self.assertEqual(stationFilenames(listing), ['AAAA.TXT', 'ESSL.TXT'])
+        self.assertEqual(stationEntries(listing)['ESSL.TXT'], '91 Feb 16 05:25')
+
+        listing = (b'<a href="AAAA.TXT">AAAA.TXT</a>     16-Feb-2017 05:20   90\n'
+                   b'<a href="ESSL.TXT">ESSL.TXT</a>     16-Feb-2017 05:25   91\n')
+        self.assertEqual(stationEntries(listing), {'AAAA.TXT': '16-Feb-2017 05:20 90',
+                                                   'ESSL.TXT': '16-Feb-2017 05:25 91'})
+
+    def testSweepStations(self):
+        reports = {'ESSL.TXT': 'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'AGGM.TXT': 'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005',
+                   'BAD.TXT': 'BAD 16052'}
+
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cacheDirectory:
+            writeStationFiles(directory, reports)
+            server = serveFixtures(directory)
+            url = 'http://127.0.0.1:%d/' % server.server_address[1]
+            fetcher = StationFetcher(timeout=5, retries=0)
+
+            try:
+                metars = {}
+                sink = lambda filename, metar: metars.__setitem__(filename, metar)
+
+                stats = sweepStations(sink, cacheDirectory, url, fetcher=fetcher)
+                self.assertEqual((stats['fetched'], stats['unchanged'], stats['skipped']), (2, 0, 0))
+                self.assertEqual(list(stats['failures']), ['BAD.TXT'])
+                self.assertEqual(metars['ESSL.TXT'], parseString(reports['ESSL.TXT']))
+
+                #A report that failed to decode is not fetched and decoded again either
+                metars.clear()
+                stats = sweepStations(sink, cacheDirectory, url, fetcher=fetcher)
+                self.assertEqual((stats['fetched'], stats['unchanged'], stats['skipped'], stats['failures']), (0, 3, 0, {}))
+                self.assertEqual(metars, {})
+                with open(os.path.join(cacheDirectory, 'index.json')) as f:
+                    self.assertTrue(json.load(f)['BAD.TXT']['failed'].startswith('ValueError'))
+
+                #A newer modification time: not a 304, fetched and decoded again
+                path = os.path.join(directory, 'ESSL.TXT')
+                mtime = os.stat(path).st_mtime
+                writeStationFiles(directory, {'ESSL.TXT': 'ESSL 160550Z 00000KT 0100 FG 01/01 Q1027'})
+                os.utime(path, (mtime + 60, mtime + 60))
+
+                stats = sweepStations(sink, cacheDirectory, url, fetcher=fetcher)
+                self.assertEqual((stats['fetched'], stats['unchanged']), (1, 2))
+                self.assertEqual(list(metars), ['ESSL.TXT'])
+                self.assertEqual(metars['ESSL.TXT']['QNH'], '1027')
+
+                #Listing details unchanged since the last sweep: not fetched at all
+                index = os.path.join(cacheDirectory, 'index.json')
+                with open(index) as f:
+                    entries = json.load(f)
+                for entry in entries.values():
+                    entry['listing'] = 'cached'
+                with open(index, 'w') as f:
+                    json.dump(entries, f)
+
+                with unittest.mock.patch('decomet.stationEntries', return_value={'ESSL.TXT': 'cached', 'AGGM.TXT': 'new'}):
+                    stats = sweepStations(sink, cacheDirectory, url, fetcher=fetcher)
+                self.assertEqual((stats['skipped'], stats['unchanged']), (1, 1))
+            finally:
+                fetcher.close()
+                server.shutdown()
+                server.server_close()
+
+    def testMetarCache(self):
+        cache = MetarCache(maxSize=2)
+        essl = 'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026'
+        aggm = 'AGGM 020300Z 09005KT 25KM HZ FEW020 SCT300 33/25 Q1005'
+        egll = 'EGLL 161150Z 24015G25KT 9999 -RA FEW015 12/09 Q1012'
+
+        metar = cache(essl)
+        self.assertEqual(metar, parseString(essl))
+
+        metar['wind']['speed'] = '99'
+        metar['visibility'].clear()
+        self.assertEqual(cache(essl), parseString(essl))
+
+        cache(aggm)
+        cache(egll)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2, 'maxSize': 2})
+
+        cache(aggm)
+        cache(essl)
+        self.assertEqual(cache.stats()['misses'], 4)
+        self.assertEqual(list(cache.entries), [aggm, essl])
+
+        with self.assertRaises(ValueError):
+            cache('BAD 16052')
+        self.assertNotIn('BAD 16052', cache.entries)
+
+        shared = MetarCache(decoder=parseRecord, copy=False)
+        self.assertIs(shared(essl), shared(essl))
+
+    def testProfiling(self):
+        strings = ['ESSL 160520Z 00000KT 0100 FG 01/01 Q1026',
+                   'ESSA 161150Z VRB03KT CAVOK M02/M08 Q1032 NOSIG RMK AO2']
+
+        with profiling() as stats:
+            self.assertTrue(hasattr(parseWind, 'parser'))
+            for string in strings:
+                parseString(string)
+            with self.assertRaises(ValueError):
+                parseString('BAD 16052')
+
+        self.assertIsNone(profiler)
+        self.assertFalse(hasattr(parseWind, 'parser'))
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['reports'], 3)
+        self.assertEqual(snapshot['tokenCounts'], {7: 1, 9: 1, 2: 1})
+
+        visibility = snapshot['groups']['parseVisibility']
+        self.assertEqual((visibility['calls'], visibility['successes'], visibility['failures']), (2, 2, 0))
+        self.assertEqual(snapshot['groups']['parseTime']['errors'], 1)
+        self.assertEqual(snapshot['groups']['parseRemark']['successes'], 1)
+        self.assertEqual(snapshot['groups']['parseTrend']['successes'], 1)
+        self.assertGreater(snapshot['groups']['parseWind']['seconds'], 0)
+
+        parseString(strings[0])
+        self.assertEqual(stats.snapshot()['reports'], 3)
+
+        #Concurrent calls wrap the parsers once and unwrap them fully
+        barrier = threading.Barrier(8)
+        def toggle(function):
+            barrier.wait()
+            function()
+        for function in (enableProfiling, disableProfiling):
+            threads = [threading.Thread(target=toggle, args=(function,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if function is enableProfiling:
+                self.assertFalse(hasattr(parseWind.parser, 'parser'))
+        self.assertFalse(hasattr(parseWind, 'parser'))
+
+    def testRegisterGroup(self):
+        def parseAltimeter(tokens, metar):
+            if tokens[0][0] != 'A':
+                return False
+            metar['altimeter'] = tokens.pop(0)[1:]
+            return True
+
+        string = 'KJFK 161151Z 24015KT 10SM FEW015 12/09 A2992 RMK AO2'
+        self.assertNotIn('altimeter', parseString(string))
+
+        registerGroup(parseAltimeter, 6, 'A')
+        try:
+            metar = parseString(string.replace(' 10SM', ''))
+            self.assertEqual(metar['altimeter'], '2992')
+            self.assertEqual(metar['remark'], 'AO2')
+
+            metar = parseString('ESSL 160520Z 00000KT 0100 FG 01/01 Q1026 A2992')
+            self.assertNotIn('altimeter', metar)
+        finally:
+            del groupTypes['parseAltimeter']
+            buildDispatch()
+
+        self.assertNotIn('altimeter', parseString(string.replace(' 10SM', '')))
+
+    def testParseGroupsStops(self):
+        tokens = ['00000KT', '0100', 'FG', 'BLSN', '01/01', 'Q1026']
+        metar = {}
+        parseGroups(tokens, metar)
+
+        self.assertEqual(tokens, ['BLSN', '01/01', 'Q1026'])
+        self.assertEqual(metar['precipitation']['type'], 'fog')
+
+        string = 'EDDF 160520Z 33020KT 4000 BR BKN012 10/05 Q1015 BECMG 4000'
+        self.assertEqual(parseString(string)['QNH'], '1015')
+        with self.assertRaises(ValueError):
+            parseString(string, strict=True)
+
+    def testParseLenient(self):
+        string = 'ESSL 160520Z 00000KT 0100 FG 01/01 Q1026'
+        self.assertEqual(parseLenient(string), parseString(string))
+
+        counts = Counter()
+        metar = parseLenient('BGCH 271228Z 07013KT 3000 -SN BLSN DRSN VV009 M07/M09 Q1002', counts)
+        self.assertEqual(metar['precipitation']['type'], 'snow')
+        self.assertEqual(metar['temperature'], '-7')
+        self.assertEqual(metar['QNH'], '1002')
+        self.assertEqual(metar['unparsed'], ['BLSN', 'DRSN'])
+        self.assertEqual(metar['errors'], [('unknownGroup', 'BLSN'), ('unknownGroup', 'DRSN')])
+
+        metar = parseLenient('ABBN 160530Z 23004KT 9999 NSC 02/M05 Q1029 R14R/CLRD60 NOSIG RMK G/O QFE696', counts)
+        self.assertEqual(metar['unparsed'], ['R14R/CLRD60'])
+        self.assertEqual(metar['trends'], [{'type': 'No significant change expected'}])
+        self.assertEqual(metar['remark'], 'G/O QFE696')
+
+        metar = parseLenient('ESSL 16052 00000KT 0100 FG 01/01 Q1026 24119195 TEMPO', counts)
+        self.assertEqual(metar['errors'], [('badTime', '16052'), ('badGroup', '24119195'), ('badGroup', 'TEMPO')])
+        self.assertEqual(metar['QNH'], '1026')
+        self.assertNotIn('runway', metar)
+
+        metar = parseLenient('  ', counts)
+        self.assertEqual(metar['errors'], [('empty', '  ')])
+
+        self.assertEqual(counts, Counter({'reports': 4, 'reportsWithErrors': 4, 'unknownGroup': 3,
+                                          'badGroup': 2, 'badTime': 1, 'empty': 1}))
+
+    def testObservationStore(self):
+        reports = [('ESSL 010520Z 00000KT 0100 FG 01/01 Q1026', datetime.datetime(2017, 3, 1, 5, 20)),
+                   ('EGLL 010520Z 24015G25KT 9999 -RA FEW015 BKN030CB 12/09 Q1012', datetime.datetime(2017, 3, 1, 5, 20)),
+                   ('EGLL 311150Z 24010KT CAVOK 14/08 Q1015', datetime.datetime(2017, 3, 31, 11, 50)),
+                   ('EGLL 280550Z 24010KT 3000 BR OVC002 M01/M02 Q0998', datetime.datetime(2017, 2, 28, 5, 50)),
+                   ('EGLL 010020Z 24010KT 8000 12/08 Q1015', datetime.datetime(2017, 4, 1, 0, 20))]
+
+        with tempfile.TemporaryDirectory() as directory:
+            with ObservationStore(directory, segmentSize=2) as store:
+                for string, observed in reports:
+                    store.append(string, observed)
+
+                self.assertEqual(len(store), 5)
+                self.assertEqual(store.stations(), ['EGLL', 'ESSL'])
+
+                march = store.query('EGLL', datetime.datetime(2017, 3, 1), datetime.datetime(2017, 4, 1), raw=True)
+                self.assertEqual([observation['raw'] for observation in march], [reports[1][0], reports[2][0]])
+                self.assertEqual(march[0]['windGust'], 25)
+                self.assertEqual(march[0]['cloudHeight'][:2], [1500, 3000])
+                self.assertEqual(march[1]['visibility'], 10000)
+                self.assertEqual(march[0]['observed'], epochSeconds(reports[1][1]))
+
+            self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith('.dat')),
+                             ['segment-000000.dat', 'segment-000001.dat', 'segment-000002.dat'])
+
+            #Crash in the middle of a record
+            with open(os.path.join(directory, 'segment-000002.dat'), 'ab') as f:
+                f.write(b'EG')
+
+            with ObservationStore(directory, segmentSize=2) as store:
+                self.assertEqual(len(store), 5)
+                self.assertEqual(store.reports('EGLL'), [reports[3][0], reports[1][0], reports[2][0], reports[4][0]])
+                self.assertEqual(store.query('EGLL', end=datetime.datetime(2017, 3, 1))[0]['temperature'], -1)
+
+                store.append('ESSL 010550Z 00000KT 0200 FG 01/01 Q1027', datetime.datetime(2017, 3, 1, 5, 50))
+                self.assertEqual(store.reports('ESSL', datetime.datetime(2017, 3, 1, 5, 30)),
+                                 ['ESSL 010550Z 00000KT 0200 FG 01/01 Q1027'])
+                self.assertEqual(store.query('ESSL')[0]['QNH'], 1026)
+
+                #Shorter airports are found before and after reopening
+                store.append('KJF 010600Z 00000KT 9999 01/01 A2992', datetime.datetime(2017, 3, 1, 6))
+                self.assertEqual(len(store.query('KJF')), 1)
+
+            with ObservationStore(directory, segmentSize=2) as store:
+                self.assertEqual([observation['airport'] for observation in store.query('KJF')], ['KJF'])
+                self.assertIn('KJF', store.stations())
+                store.append('ESSL 010620Z 00000KT 0300 FG 01/01 Q1028', datetime.datetime(2017, 3, 1, 6, 20))
+
+            #Crash before the raw report of the last record was written
+            rawPath = os.path.join(directory, 'segment-000003.raw')
+            os.truncate(rawPath, os.path.getsize(rawPath) - 1)
+            with ObservationStore(directory, segmentSize=2) as store:
+                self.assertEqual(len(store), 7)
+                self.assertEqual(len(store.reports('ESSL')), 2)
+                self.assertEqual(os.path.getsize(os.path.join(directory, 'segment-000003.dat')), storeRecord.size)
+
+    def testObservationTime(self):
+        metar = parseString('ESSL 160520Z 00000KT 0100 FG 01/01 Q1026')
+        self.assertEqual(observationTime(metar, 2017, 2), datetime.datetime(2017, 2, 16, 5, 20, tzinfo=datetime.timezone.utc))
+
+    def testRollingStatistics(self):
+        statistics = RollingStatistics()
+        start = datetime.datetime(2017, 2, 16, 0, 20)
+        for hour, (temperature, wind, visibility, QNH) in enumerate([('M01', '24010KT', '9999', 1020),
+                                                                     ('01', '24020G30KT', '4000', 1018),
+                                                                     ('03', '24015G25KT', '2000', 1016),
+                                                                     ('05', '24010MPS', '8000', 1012)] * 8):
+            observed = start + datetime.timedelta(hours=hour)
+            string = 'ESSL %sZ %s %s %s/M05 Q%04d' % (observed.strftime('%d%H%M'), wind, visibility, temperature, QNH)
+            statistics.add(parseString(string), observed)
+
+        statistics.add(parseString('ESSA 160520Z 27010G20MPS CAVOK 05/01 Q1010'), datetime.datetime(2017, 2, 16, 5, 20))
+        #Late reports are ignored
+        statistics.add(parseString('ESSL 160520Z 00000KT 0100 FG 30/01 Q1026'), start)
+        self.assertEqual(statistics.late, 1)
+        #So are reports without a usable time, through the sink too
+        statistics.sink('ESSL.TXT', parseLenient('ESSL 1605Z 00000KT 0100 FG 30/01 Q1026'))
+        statistics.add(parseLenient('ESSL 320520Z 00000KT 0100 FG 30/01 Q1026'))
+        self.assertEqual(statistics.undated, 2)
+
+        snapshot = statistics.snapshot()
+        essl = snapshot['ESSL']
+        self.assertEqual(essl['temperature']['1h'], {'count': 1, 'min': 5, 'max': 5, 'mean': 5, 'change': 0})
+        self.assertEqual(essl['temperature']['6h']['count'], 6)
+        self.assertEqual(essl['temperature']['6h']['min'], -1)
+        self.assertEqual(essl['temperature']['24h']['count'], 24)
+        self.assertEqual(essl['temperature']['24h']['mean'], 2)
+        self.assertAlmostEqual(essl['gust']['6h']['max'], 30 * 0.514444)
+        self.assertEqual(essl['gust']['24h']['count'], 12)
+        self.assertEqual(essl['visibility']['6h']['min'], 2000)
+        self.assertEqual(essl['QNH']['6h']['change'], 1012 - 1016)
+        self.assertEqual(snapshot['ESSA']['gust']['1h']['max'], 20)
+        self.assertEqual(snapshot['ESSA']['visibility']['1h']['min'], 10000)
+
+        #Windows expire as of the snapshot time, and only recent samples are kept
+        snapshot = statistics.snapshot(start + datetime.timedelta(hours=32, minutes=30))
+        self.assertIsNone(snapshot['ESSL']['temperature']['1h'])
+        self.assertEqual(snapshot['ESSL']['temperature']['6h']['count'], 5)
+        self.assertIsNone(snapshot['ESSA']['temperature']['24h'])
+        self.assertEqual(len(statistics.stations['ESSL']['temperature']['24h'].samples), 23)
+
+        now = datetime.datetime(2017, 3, 1, 0, 10, tzinfo=datetime.timezone.utc)
+        self.assertEqual(recentObservationTime(parseString('ESSL 010050Z 00000KT 0100 FG 01/01 Q1026'), now),
+                         datetime.datetime(2017, 3, 1, 0, 50, tzinfo=datetime.timezone.utc))
+        self.assertEqual(recentObservationTime(parseString('ESSL 282350Z 00000KT 0100 FG 01/01 Q1026'), now),
+                         datetime.datetime(2017, 2, 28, 23, 50, tzinfo=datetime.timezone.utc))
+        self.assertEqual(recentObservationTime(parseString('ESSL 302350Z 00000KT 0100 FG 01/01 Q1026'), now),
+                         datetime.datetime(2017, 1, 30, 23, 50, tzinfo=datetime.timezone.utc))
+
+    def testWeatherIndex(self):
+        index = WeatherIndex()
+        for string in ['EGLL 010520Z 24015G25KT 3000 +TSRA BKN008CB 12/09 Q1012',
+                       'EGKK 010520Z 24015KT 2000 -RA OVC004 12/11 Q1012',
+                       'ESSL 010520Z 00000KT 0100 R27/0300V0600 FG VV001 01/01 Q1026',
+                       'ESSA 010520Z 00000KT 0500 R01/0550 BR VV002 01/01 Q1026',
+                       'EKCH 010520Z 27005KT CAVOK 10/05 Q1020 88290595']:
+            index.add(parseString(string))
+
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.weather('rain', 'heavy', 'thunderstorm'), {'EGLL'})
+        self.assertEqual(index.weather('rain'), {'EGLL', 'EGKK'})
+        self.assertEqual(index.weather(), {'EGLL', 'EGKK', 'ESSL', 'ESSA'})
+        self.assertEqual(index.below('verticalVisibility', 200), {'ESSL'})
+        self.assertEqual(index.below('runwayVisibility', 550), {'ESSL'})
+        self.assertEqual(index.atLeast('runwayVisibility', 550), {'ESSA'})
+        self.assertEqual(index.below('visibility', 2000), {'ESSL', 'ESSA'})
+        self.assertEqual(index.atLeast('visibility', 3000), {'EGLL', 'EKCH'})
+        self.assertEqual(index.below('ceiling', 500), {'EGKK'})
+        self.assertEqual(index.clouds('broken', below=1000), {'EGLL'})
+        self.assertEqual(index.clouds('overcast'), {'EGKK'})
+        self.assertEqual(index.cumulonimbus(), {'EGLL'})
+        self.assertEqual(index.CAVOK(), {'EKCH'})
+        self.assertEqual(index.runwayState('wet or puddles', '51-100%'), {'EKCH'})
+        self.assertEqual(index.runwayState(), {'EKCH'})
+
+        #A new report replaces the previous one of the station
+        index.add(parseString('EGLL 010550Z 24010KT 9999 SCT030 12/09 Q1013'))
+        self.assertEqual(index.weather('rain'), {'EGKK'})
+        self.assertEqual(index.cumulonimbus(), set())
+        self.assertEqual(index.clouds('scattered', below=5000), {'EGLL'})
+        self.assertEqual(index['EGLL']['time'], '05:50')
+
+        index.remove('ESSL')
+        self.assertEqual(index.below('verticalVisibility', 200), set())
+        self.assertEqual(len(index), 4)
+
 
 def main():
     #unittest.main()